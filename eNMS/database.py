@@ -5,6 +5,7 @@ from contextlib import contextmanager
 from datetime import datetime, timedelta
 from flask_login import current_user
 from importlib.util import module_from_spec, spec_from_file_location
+from itertools import batched
 from json import loads
 from logging import error, info, warning
 from operator import attrgetter
@@ -20,10 +21,13 @@ from sqlalchemy import (
     ForeignKey,
     inspect,
     Integer,
+    LargeBinary,
     PickleType,
+    select,
     String,
     Table,
     Text,
+    TypeDecorator,
 )
 from sqlalchemy.dialects.mysql.base import LONGTEXT, MEDIUMTEXT, MSMediumBlob
 from sqlalchemy.exc import IntegrityError, InvalidRequestError, OperationalError
@@ -42,9 +46,47 @@ from time import sleep
 from traceback import extract_stack, format_exc
 from uuid import getnode
 
+from eNMS.helpers import compress, decompress
 from eNMS.variables import vs
 
 
+def build_record(model, properties):
+    return db.get_record_class(model, tuple(properties))(**properties)
+
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, **properties):
+        for property, value in properties.items():
+            setattr(self, property, value)
+
+    def __getattr__(self, property):
+        if property not in self._deferred:
+            raise AttributeError(property)
+        table = vs.models[self._model]
+        query = select(getattr(table, property)).where(table.id == self.id)
+        with db.engine.connect() as connection:
+            value = connection.execute(query).scalar()
+        setattr(self, property, value)
+        return value
+
+    def __reduce__(self):
+        return build_record, (self._model, self.get_properties())
+
+    def __repr__(self):
+        return str(self.name)
+
+    def get_properties(self):
+        properties = {}
+        for property in self.__slots__:
+            try:
+                properties[property] = object.__getattribute__(self, property)
+            except AttributeError:
+                continue
+        return properties
+
+
 class Database:
     def __init__(self):
         for setting in vs.database.items():
@@ -52,6 +94,7 @@ class Database:
         self.database_url = getenv("DATABASE_URL", "sqlite:///database.db")
         self.dialect = self.database_url.split(":")[0]
         self.rbac_error = type("RbacError", (Exception,), {})
+        self.record_classes = {}
         self.configure_columns()
         self.engine = create_engine(
             self.database_url,
@@ -146,6 +189,9 @@ class Database:
     def cleanup(self):
         self.engine.dispose()
 
+    def compress(self, value):
+        return compress(value, **self.columns["compression"])
+
     def configure_associations(self):
         self.associations = {}
         for name, association in self.relationships["associations"].items():
@@ -249,6 +295,21 @@ class Database:
             if self.dialect.startswith(("mariadb", "mysql")):
                 impl = MSMediumBlob
 
+        class CompressedJSONType(TypeDecorator):
+            cache_ok = True
+            impl = (
+                MSMediumBlob
+                if self.dialect.startswith(("mariadb", "mysql"))
+                else LargeBinary
+            )
+
+            def process_bind_param(_, value, dialect):  # noqa: N805
+                return None if value is None else self.compress(value)
+
+            def process_result_value(_, value, dialect):  # noqa: N805
+                return None if value is None else self.decompress(value)
+
+        self.CompressedDict = MutableDict.as_mutable(CompressedJSONType)
         self.Dict = MutableDict.as_mutable(CustomPickleType)
         self.List = MutableList.as_mutable(CustomPickleType)
         if self.dialect == "postgresql":
@@ -264,6 +325,7 @@ class Database:
         self.TinyString = String(self.columns["length"]["tiny_string"])
 
         default_ctypes = {
+            self.CompressedDict: {},
             self.Dict: {},
             self.List: [],
             self.LargeString: "",
@@ -485,6 +547,9 @@ class Database:
 
         return SubDeclarativeMeta
 
+    def decompress(self, data):
+        return decompress(data)
+
     def delete(self, model, **kwargs):
         instance = self.fetch(model, **{"rbac": "edit", **kwargs})
         return self.delete_instance(instance)
@@ -611,6 +676,16 @@ class Database:
             return []
         return self.fetch(instance_type, allow_none=True, all_matches=True, **kwargs)
 
+    def fetch_records(self, model, ids):
+        table = vs.models[model]
+        properties = tuple(self.get_record_properties(model))
+        record_class, records = self.get_record_class(model, properties), []
+        query = select(*(getattr(table, property) for property in properties))
+        for batch in batched(set(ids), self.transactions["batch_size"]):
+            for row in self.session.execute(query.where(table.id.in_(batch))):
+                records.append(record_class(**dict(zip(properties, row))))
+        return records
+
     def get_credential(
         self, username, name=None, device=None, credential_type="any", optional=False
     ):
@@ -630,6 +705,42 @@ class Database:
             raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
         return credentials
 
+    def get_pool_device_ids(self, pool_ids):
+        table, device_ids = self.pool_device_table, set()
+        for batch in batched(set(pool_ids), self.transactions["batch_size"]):
+            query = select(table.c.device_id).where(table.c.pool_id.in_(batch))
+            device_ids.update(self.session.execute(query.distinct()).scalars())
+        return device_ids
+
+    def get_record(self, instance, **properties):
+        for property in self.get_record_properties(instance.type):
+            properties[property] = getattr(instance, property)
+        return build_record(instance.type, properties)
+
+    def get_record_class(self, model, properties):
+        if (model, properties) not in self.record_classes:
+            deferred = set(self.get_record_properties(model, deferred=True))
+            deferred -= set(properties)
+            name = "".join(word.capitalize() for word in model.split("_"))
+            self.record_classes[(model, properties)] = type(
+                f"{name}Record",
+                (Record,),
+                {
+                    "__slots__": (*properties, *deferred),
+                    "_deferred": frozenset(deferred),
+                    "_model": model,
+                },
+            )
+        return self.record_classes[(model, properties)]
+
+    def get_record_properties(self, model, deferred=False):
+        return [
+            column.key
+            for column in inspect(vs.models[model]).column_attrs
+            if column.deferred == deferred
+            and column.key not in vs.private_properties_set
+        ]
+
     def query(self, model, rbac="read", user=None, properties=None):
         if properties:
             entity = [getattr(vs.models[model], property) for property in properties]
@@ -1,6 +1,8 @@
 from asyncio import run as async_run
 from base64 import b64decode, b64encode
 from click import get_current_context
+from collections import Counter, defaultdict, deque, OrderedDict
+from concurrent.futures import Future
 from contextlib import contextmanager
 from cryptography.fernet import Fernet
 from dramatiq import set_broker
@@ -11,23 +13,33 @@ from email.mime.text import MIMEText
 from email.utils import formatdate
 from flask_caching import Cache
 from importlib import import_module
-from logging import Formatter, getLogger, Handler, info
+from jinja2 import (
+    Environment as JinjaEnvironment,
+    FileSystemBytecodeCache,
+    FunctionLoader,
+    StrictUndefined,
+    Undefined,
+)
+from logging import error, Formatter, getLogger, Handler, info
 from logging.config import dictConfig
 from multiprocessing import Queue
-from os import getenv
+from os import getenv, getpid
 from passlib.hash import argon2
 from pathlib import Path
+from pickle import dumps as pickle_dumps, loads as pickle_loads
+from queue import Empty, Queue as BoundedQueue
 from redis import Redis
 from redis.exceptions import ConnectionError, TimeoutError
 from requests import Session as RequestSession
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from smtplib import SMTP
+from sqlalchemy import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import StaleDataError
 from sys import path as sys_path, stderr
-from threading import Thread
-from time import perf_counter, time
+from threading import Condition, Event, local, Lock, Thread
+from time import perf_counter, sleep, time
 from traceback import format_exc, print_exc
 from uuid import uuid4
 from warnings import warn
@@ -46,9 +58,629 @@ except ImportError as exc:
     warn(f"Couldn't import temporalio module ({exc})")
 
 from eNMS.database import db
+from eNMS.helpers import CodeCache, RunLogBuffer, RunStateStore
 from eNMS.variables import vs
 
 
+class AllowedTargetCache:
+    def __init__(self, redis_queue=None, active=True, max_age=3600):
+        self.redis_queue, self.active, self.max_age = redis_queue, active, max_age
+        self.lock = Lock()
+        self.targets = {}
+        self.versions = defaultdict(int)
+
+    def get(self, user, compute):
+        version = self.get_version(user)
+        if not self.active or version is None:
+            return frozenset(compute())
+        with self.lock:
+            cached_version, timestamp, targets = self.targets.get(user, (None, 0, None))
+        if cached_version == version and time() - timestamp < self.max_age:
+            return targets
+        targets = frozenset(compute())
+        with self.lock:
+            self.targets[user] = (version, time(), targets)
+        return targets
+
+    def get_version(self, user):
+        if not self.redis_queue:
+            with self.lock:
+                return self.versions[None], self.versions[user]
+        try:
+            keys = ("allowed_targets/version", f"allowed_targets/version/{user}")
+            return tuple(int(version or 0) for version in self.redis_queue.mget(keys))
+        except (ConnectionError, TimeoutError):
+            return None
+
+    def invalidate(self, user=None):
+        with self.lock:
+            self.versions[user] += 1
+            if user:
+                self.targets.pop(user, None)
+            else:
+                self.targets.clear()
+        if not self.redis_queue:
+            return
+        key = f"allowed_targets/version/{user}" if user else "allowed_targets/version"
+        try:
+            self.redis_queue.incr(key)
+        except (ConnectionError, TimeoutError) as exc:
+            info(f"Could not invalidate the allowed targets in Redis ({exc})")
+
+
+class ConnectionPool:
+    def __init__(self, active=False, idle_ttl=300, max_size=1000):
+        self.active, self.idle_ttl, self.max_size = active, idle_ttl, max_size
+        self.connections = defaultdict(list)
+        self.lock = Lock()
+        self.lru = OrderedDict()
+
+    def borrow(self, key):
+        if not self.active:
+            return
+        while True:
+            with self.lock:
+                expired_connections = self.pop_expired_connections()
+                if not self.connections[key]:
+                    connection = None
+                else:
+                    connection = self.connections[key].pop()
+                    self.lru.pop(id(connection))
+            self.close_connections(expired_connections)
+            if not connection or self.is_alive(key[0], connection):
+                return connection
+            self.close_connections([(key, connection)])
+
+    def close_connection(self, library, connection):
+        try:
+            if library == "netmiko":
+                connection.disconnect()
+            elif library == "ncclient":
+                connection.close_session()
+            else:
+                connection.close()
+        finally:
+            lease = getattr(connection, "device_lease", None)
+            if lease:
+                lease.release()
+
+    def close_connections(self, connections):
+        for key, connection in connections:
+            try:
+                self.close_connection(key[0], connection)
+            except Exception:
+                info(f"Error closing pooled connection {key}:\n{format_exc()}")
+
+    def is_alive(self, library, connection):
+        try:
+            if library == "napalm":
+                return connection.is_alive()["is_alive"]
+            elif library == "ncclient":
+                return connection.connected
+            elif library == "scrapli":
+                return connection.isalive()
+            channel = connection.remote_conn
+            if hasattr(channel, "get_transport"):
+                return not channel.closed and channel.get_transport().is_active()
+            return connection.is_alive()
+        except Exception:
+            return False
+
+    def pop_expired_connections(self):
+        expired_connections, now = [], time()
+        while self.lru:
+            key, connection, release_time = next(iter(self.lru.values()))
+            expired = now - release_time > self.idle_ttl
+            if not expired and len(self.lru) <= self.max_size:
+                break
+            self.lru.popitem(last=False)
+            self.connections[key].remove(connection)
+            expired_connections.append((key, connection))
+        return expired_connections
+
+    def release(self, connection):
+        key = connection.pool_key
+        with self.lock:
+            self.connections[key].append(connection)
+            self.lru[id(connection)] = (key, connection, time())
+            expired_connections = self.pop_expired_connections()
+        self.close_connections(expired_connections)
+
+
+class ConnectionSlot:
+    def __init__(self, executor, lease=None):
+        self.executor, self.lease = executor, lease
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.lease:
+            self.lease.release()
+        self.executor.release_connection()
+
+
+class DeviceLease:
+    def __init__(self, manager, device, token):
+        self.manager, self.device, self.token = manager, device, token
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.manager.release(self)
+
+
+class DeviceLeaseManager:
+    acquire_script = """
+        redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[1])
+        local held = redis.call("ZSCORE", KEYS[1], ARGV[4])
+        if not held and redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[3]) then
+            return 0
+        end
+        redis.call("ZADD", KEYS[1], ARGV[2], ARGV[4])
+        redis.call("PEXPIRE", KEYS[1], ARGV[5])
+        return 1
+    """
+
+    def __init__(
+        self,
+        redis_queue=None,
+        active=False,
+        default_limit=0,
+        platform_limits=None,
+        ttl=300,
+        poll_interval=1,
+        timeout=0,
+    ):
+        self.redis_queue, self.active = redis_queue, active
+        self.default_limit, self.platform_limits = default_limit, platform_limits or {}
+        self.ttl, self.poll_interval, self.timeout = ttl, poll_interval, timeout
+        self.condition = Condition()
+        self.leases = defaultdict(dict)
+        self.thread = None
+        if redis_queue:
+            self.acquire_lease = redis_queue.register_script(self.acquire_script)
+
+    def acquire(self, device, owner):
+        limit = self.get_limit(device)
+        if not self.active or not limit:
+            return
+        lease = DeviceLease(self, device.name, f"{owner}@{getpid()}")
+        with self.condition:
+            holders = self.leases[lease.device]
+            if lease.token in holders:
+                holders[lease.token] += 1
+                return lease
+        deadline = time() + self.timeout if self.timeout else None
+        if self.redis_queue:
+            self.acquire_redis_lease(lease, limit, deadline)
+        else:
+            with self.condition:
+                acquired = self.condition.wait_for(
+                    lambda: lease.token in self.leases[lease.device]
+                    or len(self.leases[lease.device]) < limit,
+                    timeout=deadline and max(deadline - time(), 0),
+                )
+                if not acquired:
+                    raise Exception(self.timeout_error(lease.device, limit))
+                self.hold(lease)
+        return lease
+
+    def acquire_redis_lease(self, lease, limit, deadline):
+        key = f"device_leases/{lease.device}"
+        while True:
+            now = time()
+            arguments = (now, now + self.ttl, limit, lease.token, self.ttl * 1000)
+            if self.acquire_lease(keys=[key], args=arguments):
+                break
+            if deadline and now > deadline:
+                raise Exception(self.timeout_error(lease.device, limit))
+            sleep(self.poll_interval)
+        with self.condition:
+            self.hold(lease)
+            if not self.thread or not self.thread.is_alive():
+                self.thread = Thread(target=self.run_renewer, daemon=True)
+                self.thread.start()
+
+    def get_limit(self, device):
+        return (
+            getattr(device, "max_sessions", None)
+            or self.platform_limits.get(getattr(device, "operating_system", None))
+            or self.default_limit
+        )
+
+    def hold(self, lease):
+        holders = self.leases[lease.device]
+        holders[lease.token] = holders.get(lease.token, 0) + 1
+
+    def release(self, lease):
+        with self.condition:
+            holders = self.leases.get(lease.device, {})
+            holders[lease.token] = holders.get(lease.token, 1) - 1
+            if holders[lease.token] > 0:
+                return
+            holders.pop(lease.token)
+            if not holders:
+                self.leases.pop(lease.device, None)
+            self.condition.notify_all()
+            if not self.redis_queue:
+                return
+            try:
+                self.redis_queue.zrem(f"device_leases/{lease.device}", lease.token)
+            except (ConnectionError, TimeoutError) as exc:
+                error(f"Could not release the session lease of {lease.device} ({exc})")
+
+    def renew(self):
+        with self.condition:
+            leases = [(device, set(tokens)) for device, tokens in self.leases.items()]
+        if not leases:
+            return
+        pipeline, expiry = (
+            self.redis_queue.pipeline(transaction=False),
+            time() + self.ttl,
+        )
+        for device, tokens in leases:
+            key = f"device_leases/{device}"
+            pipeline.zadd(key, dict.fromkeys(tokens, expiry), xx=True)
+            pipeline.expire(key, self.ttl)
+        pipeline.execute(raise_on_error=False)
+
+    def run_renewer(self):
+        while True:
+            sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception:
+                error(f"Failed to renew the device session leases:\n{format_exc()}")
+
+    def timeout_error(self, device, limit):
+        return (
+            f"Timed out after {self.timeout}s waiting for one of the {limit} session"
+            f" slots of {device}: all of them are used by other runs"
+        )
+
+
+class GatewayTransportPool:
+    def __init__(self, active=False, keepalive=30, failure_ttl=30, parallel_attempts=1):
+        self.active, self.keepalive = active, keepalive
+        self.failure_ttl, self.parallel_attempts = failure_ttl, parallel_attempts
+        self.clients, self.failures = {}, {}
+        self.lock, self.locks = Lock(), defaultdict(Lock)
+
+    def get(self, key, connect):
+        with self.lock:
+            key_lock = self.locks[key]
+        with key_lock:
+            client = self.clients.get(key)
+            transport = client and client.get_transport()
+            if transport and transport.is_active():
+                return transport
+            failure_time = self.failures.get(key)
+            if failure_time and time() - failure_time < self.failure_ttl:
+                raise Exception(
+                    f"Gateway {key[0]} failed less than {self.failure_ttl}s ago"
+                )
+            if client:
+                client.close()
+            try:
+                client = connect()
+            except Exception:
+                self.clients.pop(key, None)
+                self.failures[key] = time()
+                raise
+            self.failures.pop(key, None)
+            self.clients[key] = client
+            transport = client.get_transport()
+            if self.keepalive:
+                transport.set_keepalive(self.keepalive)
+            return transport
+
+
+class JobExecutor:
+    def __init__(
+        self,
+        active=False,
+        max_workers=100,
+        run_quota=0,
+        max_connections=0,
+        connection_timeout=300,
+    ):
+        self.active, self.max_workers, self.run_quota = active, max_workers, run_quota
+        self.max_connections = max_connections
+        self.connection_timeout = connection_timeout
+        self.condition, self.connection_condition = Condition(), Condition()
+        self.queues = OrderedDict()
+        self.quotas, self.running = {}, defaultdict(int)
+        self.group_running = defaultdict(int)
+        self.threads, self.idle_threads, self.queued, self.completed = [], 0, 0, 0
+        self.blocked_threads, self.connections = 0, 0
+        self.worker = local()
+
+    def acquire_connection(self, lease=None):
+        if not self.active or not self.max_connections:
+            return lease
+        with self.connection_condition:
+            acquired = self.connection_condition.wait_for(
+                lambda: self.connections < self.max_connections,
+                timeout=self.connection_timeout or None,
+            )
+            if not acquired:
+                if lease:
+                    lease.release()
+                raise Exception(
+                    f"Timed out after {self.connection_timeout}s waiting for one of"
+                    f" the {self.max_connections} connection slots of the process"
+                )
+            self.connections += 1
+        return ConnectionSlot(self, lease)
+
+    @contextmanager
+    def blocking(self):
+        job = getattr(self.worker, "job", None)
+        if not job:
+            yield
+            return
+        with self.condition:
+            self.update_running(job, -1)
+            self.blocked_threads += 1
+            self.start_worker()
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.update_running(job, 1)
+                self.blocked_threads -= 1
+
+    def get_quota(self, group):
+        return self.quotas.get(group) or self.max_workers
+
+    def map(self, user, runtime, group, function, iterable, quota=None):
+        futures = [
+            self.submit(user, runtime, group, function, arg, quota=quota)
+            for arg in iterable
+        ]
+        with self.blocking():
+            return [future.result() for future in futures]
+
+    def next_job(self):
+        for user, runs in self.queues.items():
+            for runtime, groups in runs.items():
+                if self.run_quota and self.running.get(runtime, 0) >= self.run_quota:
+                    continue
+                for group, queue in groups.items():
+                    running = self.group_running.get((runtime, group), 0)
+                    if running >= self.get_quota(group):
+                        continue
+                    job = queue.popleft()
+                    self.queued -= 1
+                    if queue:
+                        groups.move_to_end(group)
+                    else:
+                        groups.pop(group)
+                    if groups:
+                        runs.move_to_end(runtime)
+                    else:
+                        runs.pop(runtime)
+                    if runs:
+                        self.queues.move_to_end(user)
+                    else:
+                        self.queues.pop(user)
+                    self.update_running((runtime, group), 1)
+                    return (runtime, group, *job)
+
+    def release_connection(self):
+        with self.connection_condition:
+            self.connections -= 1
+            self.connection_condition.notify()
+
+    @property
+    def statistics(self):
+        with self.condition:
+            queued, running = defaultdict(Counter), defaultdict(dict)
+            for runs in self.queues.values():
+                for runtime, groups in runs.items():
+                    for group, queue in groups.items():
+                        queued[runtime][group] += len(queue)
+            for (runtime, group), jobs in self.group_running.items():
+                running[runtime][group] = jobs
+            return {
+                "threads": len(self.threads),
+                "idle_threads": self.idle_threads,
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "running": sum(self.running.values()),
+                "completed": self.completed,
+                "blocked_threads": self.blocked_threads,
+                "connections": self.connections,
+                "max_connections": self.max_connections,
+                "runs": {
+                    runtime: {
+                        "queued": sum(queued[runtime].values()),
+                        "running": self.running.get(runtime, 0),
+                        "quota": self.run_quota or self.max_workers,
+                        "services": {
+                            group: {
+                                "queued": queued[runtime][group],
+                                "running": running[runtime].get(group, 0),
+                                "quota": self.get_quota(group),
+                            }
+                            for group in set(queued[runtime]) | set(running[runtime])
+                        },
+                    }
+                    for runtime in set(queued) | set(self.running)
+                },
+            }
+
+    def set_quota(self, group, quota):
+        with self.condition:
+            self.quotas[group] = quota
+            self.condition.notify_all()
+
+    def submit(self, user, runtime, group, function, *args, quota=None):
+        future = Future()
+        with self.condition:
+            if quota:
+                self.quotas[group] = quota
+            runs = self.queues.setdefault(user, OrderedDict())
+            groups = runs.setdefault(runtime, OrderedDict())
+            groups.setdefault(group, deque()).append((future, function, args))
+            self.queued += 1
+            self.start_worker()
+            self.condition.notify()
+        return future
+
+    def start_worker(self):
+        workers = len(self.threads) - self.blocked_threads
+        if self.idle_threads < self.queued and workers < self.max_workers:
+            thread = Thread(target=self.work, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def update_running(self, job, increment):
+        runtime, group = job
+        for counter, key in ((self.running, runtime), (self.group_running, job)):
+            counter[key] += increment
+            if not counter[key]:
+                counter.pop(key)
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.idle_threads += 1
+                while not (job := self.next_job()):
+                    self.condition.wait()
+                self.idle_threads -= 1
+            runtime, group, future, function, args = job
+            if future.set_running_or_notify_cancel():
+                self.worker.job = (runtime, group)
+                try:
+                    future.set_result(function(*args))
+                except BaseException as exc:
+                    future.set_exception(exc)
+                finally:
+                    self.worker.job = None
+                    db.session.remove()
+            with self.condition:
+                self.completed += 1
+                self.update_running((runtime, group), -1)
+                if (runtime, group) not in self.group_running and not any(
+                    group in runs.get(runtime, ()) for runs in self.queues.values()
+                ):
+                    self.quotas.pop(group, None)
+                self.condition.notify_all()
+
+
+class ResultWriter:
+    def __init__(self, active=False, queue_size=10000, retries=3, retry_interval=1):
+        self.active, self.queue = active, BoundedQueue(maxsize=queue_size)
+        self.retries, self.retry_interval = retries, retry_interval
+        self.failures = defaultdict(int)
+        self.lock = Lock()
+        self.thread = None
+
+    def add(self, result):
+        with self.lock:
+            if not self.thread or not self.thread.is_alive():
+                self.thread = Thread(target=self.run_writer, daemon=True)
+                self.thread.start()
+        self.queue.put(result)
+
+    def flush(self):
+        if not self.thread or not self.thread.is_alive():
+            return
+        event = Event()
+        self.queue.put(event)
+        event.wait()
+
+    def pop_failures(self, runtime):
+        with self.lock:
+            return self.failures.pop(runtime, 0)
+
+    def run_writer(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < vs.database["transactions"]["batch_size"]:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            results = [item for item in items if not isinstance(item, Event)]
+            if results:
+                self.write(results)
+            for item in items:
+                if isinstance(item, Event):
+                    item.set()
+
+    def insert(self, results):
+        try:
+            with db.session_scope(commit=True):
+                db.session.execute(insert(vs.models["result"]), results)
+            return True
+        except Exception:
+            error(f"Failed to write {len(results)} results:\n{format_exc()}")
+            return False
+
+    def write(self, results):
+        for attempt in range(self.retries + 1):
+            if self.insert(results):
+                return
+            if attempt < self.retries:
+                sleep(self.retry_interval)
+        for result in results:
+            if not self.insert([result]):
+                with self.lock:
+                    self.failures[result["parent_runtime"]] += 1
+
+
+class TopologyCache:
+    def __init__(self, redis_queue=None, max_size=100, redis_ttl=0):
+        self.redis_queue = redis_queue
+        self.max_size, self.redis_ttl = max_size, redis_ttl
+        self.lock = Lock()
+        self.topologies = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.topologies:
+                self.topologies.move_to_end(key)
+                return self.topologies[key]
+        if not self.redis_queue or not self.redis_ttl:
+            return
+        try:
+            topology = self.redis_queue.get(f"topology/{key}")
+        except (ConnectionError, TimeoutError):
+            return
+        if topology:
+            topology = pickle_loads(b64decode(topology))
+            self.store(key, topology)
+            return topology
+
+    def invalidate(self, service_id):
+        with self.lock:
+            for key, topology in list(self.topologies.items()):
+                if service_id in topology["services"]:
+                    self.topologies.pop(key)
+
+    def set(self, key, topology):
+        self.store(key, topology)
+        if not self.redis_queue or not self.redis_ttl:
+            return
+        data = b64encode(pickle_dumps(topology))
+        try:
+            self.redis_queue.set(f"topology/{key}", data, ex=self.redis_ttl)
+        except (ConnectionError, TimeoutError) as exc:
+            info(f"Could not store the topology in Redis ({exc})")
+
+    def store(self, key, topology):
+        with self.lock:
+            self.topologies[key] = topology
+            while len(self.topologies) > self.max_size:
+                self.topologies.popitem(last=False)
+
+
 class Environment(vs.TimingMixin):
     def __init__(self):
         if vs.settings["automation"]["task_queue"] == "dramatiq":
@@ -67,7 +699,7 @@ class Environment(vs.TimingMixin):
         if vs.settings["paths"]["custom_code"]:
             sys_path.append(vs.settings["paths"]["custom_code"])
         self.init_redis()
-        self.init_connection_pools()
+        self.init_run_helpers()
         self.cache = Cache(config=vs.settings["cache"]["config"])
         Path(vs.settings["files"]["trash"]).mkdir(parents=True, exist_ok=True)
         self.ssh_port = -1
@@ -139,6 +771,9 @@ class Environment(vs.TimingMixin):
             password = str.encode(password)
         return self.encrypt(password)
 
+    def get_jinja2_template(self, source, strict=False):
+        return self.jinja2_environments[strict].get_template(source)
+
     def get_password(self, password):
         if not password:
             return
@@ -158,7 +793,16 @@ class Environment(vs.TimingMixin):
     def get_workers(self):
         return {worker.name: worker.to_dict() for worker in db.fetch_all("worker")}
 
+    def init_allowed_target_cache(self):
+        self.allowed_targets = AllowedTargetCache(
+            self.redis_queue, **vs.automation["allowed_target_cache"]
+        )
+
+    def init_code_cache(self):
+        self.code_cache = CodeCache(**vs.automation["code_cache"])
+
     def init_connection_pools(self):
+        self.connection_pool = ConnectionPool(**vs.automation["connection_pool"])
         self.request_session = RequestSession()
         retry = Retry(**vs.settings["requests"]["retries"])
         for protocol in ("http", "https"):
@@ -167,6 +811,11 @@ class Environment(vs.TimingMixin):
                 HTTPAdapter(max_retries=retry, **vs.settings["requests"]["pool"]),
             )
 
+    def init_device_leases(self):
+        self.device_leases = DeviceLeaseManager(
+            self.redis_queue, **vs.automation["device_leases"]
+        )
+
     def init_dramatiq(self):
         set_broker(
             RedisBroker(
@@ -205,6 +854,11 @@ class Environment(vs.TimingMixin):
             task_queue="enms-task-queue",
         )
 
+    def init_gateway_transports(self):
+        self.gateway_transports = GatewayTransportPool(
+            **vs.automation["gateway_transports"]
+        )
+
     def init_encryption(self):
         self.fernet_encryption = getenv("FERNET_KEY")
         if self.fernet_encryption:
@@ -213,6 +867,20 @@ class Environment(vs.TimingMixin):
         else:
             self.encrypt, self.decrypt = b64encode, b64decode
 
+    def init_jinja2_environments(self):
+        bytecode_cache = FileSystemBytecodeCache()
+        self.jinja2_environments = {
+            strict: JinjaEnvironment(
+                loader=FunctionLoader(lambda source: source),
+                bytecode_cache=bytecode_cache,
+                undefined=StrictUndefined if strict else Undefined,
+            )
+            for strict in (False, True)
+        }
+
+    def init_job_executor(self):
+        self.job_executor = JobExecutor(**vs.automation["job_executor"])
+
     def init_logs(self):
         folder = vs.path / "logs"
         folder.mkdir(parents=True, exist_ok=True)
@@ -232,6 +900,37 @@ class Environment(vs.TimingMixin):
         else:
             self.redis_queue = Redis(host=host, **vs.settings["redis"]["config"])
 
+    def init_result_writer(self):
+        self.result_writer = ResultWriter(**vs.automation["result_writer"])
+
+    def init_run_helpers(self):
+        self.init_allowed_target_cache()
+        self.init_result_writer()
+        self.init_run_log_buffer()
+        self.init_run_state_store()
+        self.init_topology_cache()
+        self.init_code_cache()
+        self.init_job_executor()
+        self.init_device_leases()
+        self.init_gateway_transports()
+        self.init_connection_pools()
+        self.init_jinja2_environments()
+
+    def init_run_log_buffer(self):
+        self.run_log_buffer = RunLogBuffer(
+            self.redis_queue, **vs.automation["run_log_buffer"]
+        )
+
+    def init_run_state_store(self):
+        self.run_state_store = RunStateStore(
+            self.redis_queue, vs.run_states, **vs.automation["run_state"]
+        )
+
+    def init_topology_cache(self):
+        self.topology_cache = TopologyCache(
+            self.redis_queue, **vs.automation["topology_cache"]
+        )
+
     @vs.custom_function
     def init_vault_client(self):
         url = getenv("VAULT_ADDR", "http://127.0.0.1:8200")
@@ -287,10 +986,9 @@ class Environment(vs.TimingMixin):
             key = f"{runtime}/{service}/logs"
             vs.run_logs[runtime][int(service)] = None
             if mode == "add":
-                log = self.redis("lpush", key, log)
+                log = self.run_log_buffer.add(runtime, key, log)
             else:
-                bound = self.redis("llen", key) - start_line - 1
-                log = [] if bound == -1 else self.redis("lrange", key, 0, bound)[::-1]
+                log = self.run_log_buffer.read(runtime, key, start_line)
         else:
             if mode == "add":
                 return vs.run_logs[runtime][int(service)].append(log)
@@ -762,6 +762,7 @@ class ServiceForm(BaseForm):
         choices=(("name", "Name"), ("ip_address", "IP address")),
         no_search=True,
     )
+    iteration_max_concurrency = IntegerField("Iteration Maximum Concurrency", default=1)
     preprocessing = StringField(
         type="code", python=True, widget=TextArea(), help="common/preprocessing"
     )
@@ -786,7 +787,17 @@ class ServiceForm(BaseForm):
     )
     show_user_logs = BooleanField("Always Show User-Defined Logs", default=True)
     multiprocessing = BooleanField("Multiprocessing", help="common/multiprocessing")
+    multiprocessing_mode = SelectField(
+        "Multiprocessing Mode",
+        choices=(
+            ("thread", "Thread Pool"),
+            ("asyncio", "Asyncio Event Loop"),
+            ("process", "Process Pool (High Performance only)"),
+        ),
+        no_search=True,
+    )
     max_processes = IntegerField("Maximum number of processes", default=15)
+    adaptive_concurrency = BooleanField("Adaptive Concurrency (Thread Pool only)")
     validation_condition = SelectField(
         choices=(
             ("none", "No validation"),
@@ -879,13 +890,16 @@ class ServiceForm(BaseForm):
             "device_query",
             "device_query_property",
             "multiprocessing",
+            "multiprocessing_mode",
             "max_processes",
+            "adaptive_concurrency",
         ],
         "step3-2": [
             "iteration_devices",
             "iteration_devices_property",
             "iteration_values",
             "iteration_variable_name",
+            "iteration_max_concurrency",
         ],
         "step4-1": [
             "conversion_method",
@@ -970,15 +984,28 @@ class ServiceForm(BaseForm):
                 f"The validation method is set to '{self.validation_method.data}'"
                 f" and the matching value is empty: these do no match."
             )
-        max_process = vs.settings["automation"]["max_process"] * (
-            10 if self.high_performance.data else 1
-        )
+        mode = self.multiprocessing_mode.data
+        if mode == "asyncio":
+            max_process = vs.settings["automation"]["max_coroutines"]
+        elif mode == "process" or not self.high_performance.data:
+            max_process = vs.settings["automation"]["max_process"]
+        else:
+            max_process = vs.settings["automation"]["max_process"] * 10
+        unit = {"asyncio": "coroutines", "process": "processes"}.get(mode, "threads")
         too_many_threads_error = self.max_processes.data > max_process
         if too_many_threads_error:
             self.max_processes.errors.append(
-                "The number of threads used for multiprocessing must be "
+                f"The number of {unit} used for multiprocessing must be "
                 f"less than {max_process}."
             )
+        max_iterations = vs.settings["automation"]["max_process"]
+        iteration_concurrency = self.iteration_max_concurrency.data or 1
+        iteration_concurrency_error = iteration_concurrency > max_iterations
+        if iteration_concurrency_error:
+            self.iteration_max_concurrency.errors.append(
+                "The maximum number of concurrent iterations must be "
+                f"less than {max_iterations}."
+            )
         shared_service_error = not self.shared.data and len(self.workflows.data) > 1
         if shared_service_error:
             self.shared.errors.append(
@@ -991,6 +1018,7 @@ class ServiceForm(BaseForm):
             and not invalid_multiprocessing_error
             and not empty_validation
             and not forbidden_name_error
+            and not iteration_concurrency_error
             and not no_recipient_error
             and not shared_service_error
             and not too_many_threads_error
@@ -1172,6 +1200,7 @@ class DeviceForm(ObjectForm):
     )
     ip_address = StringField("IP address")
     port = IntegerField("Port", default=22)
+    max_sessions = IntegerField("Maximum Concurrent Sessions", default=0)
     os_version = StringField("OS Version")
     latitude = StringField("Latitude", default=0.0)
     longitude = StringField("Longitude", default=0.0)
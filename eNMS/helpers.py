@@ -0,0 +1,297 @@
+from builtins import compile as compile_source
+from collections import defaultdict, OrderedDict
+from hashlib import sha256
+from json import dumps
+from logging import error
+from math import isfinite
+from orjson import (
+    dumps as or_dumps,
+    JSONEncodeError,
+    loads as or_loads,
+    OPT_PASSTHROUGH_DATACLASS,
+    OPT_PASSTHROUGH_DATETIME,
+)
+from pickle import dumps as pickle_dumps, loads as pickle_loads
+from threading import Lock, Thread
+from time import sleep
+from traceback import format_exc
+from warnings import warn
+from zlib import compress as zlib_compress, decompress as zlib_decompress
+
+try:
+    from zstandard import ZstdCompressor, ZstdDecompressor
+except ImportError as exc:
+    warn(f"Couldn't import zstandard module ({exc})")
+
+
+class CodeCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.code_objects = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = Lock()
+        self.services = {}
+
+    def compile(self, source, mode="eval", service=None, filename="<string>"):
+        key = (sha256(source.encode("utf-8")).hexdigest(), mode, filename)
+        with self.lock:
+            if service is not None:
+                self.invalidate(service)
+            if key in self.code_objects:
+                self.hits += 1
+                self.code_objects.move_to_end(key)
+                code = self.code_objects[key]
+            else:
+                code = None
+        if code is None:
+            code = compile_source(source, filename, mode)
+            with self.lock:
+                self.misses += 1
+                self.code_objects[key] = code
+                while len(self.code_objects) > self.max_size:
+                    self.code_objects.popitem(last=False)
+        if service is not None:
+            with self.lock:
+                last_modified = getattr(service, "last_modified", None)
+                self.services.setdefault(service.id, (last_modified, set()))[1].add(key)
+        return code
+
+    def invalidate(self, service):
+        last_modified = getattr(service, "last_modified", None)
+        tracked = self.services.setdefault(service.id, (last_modified, set()))
+        if tracked[0] == last_modified:
+            return
+        for key in tracked[1]:
+            self.code_objects.pop(key, None)
+        self.services[service.id] = (last_modified, set())
+
+    @property
+    def statistics(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.code_objects),
+        }
+
+
+class ReadOnlyDict(dict):
+    def __readonly__(self, *args, **kwargs):
+        raise TypeError(f"'{type(self).__name__}' object is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = __readonly__
+    clear = pop = popitem = setdefault = update = __readonly__
+
+
+class RunLogBuffer:
+    def __init__(self, redis_queue=None, flush_interval=0.5, max_size=1000):
+        self.redis_queue, self.flush_interval = redis_queue, flush_interval
+        self.flush_lock, self.lock = Lock(), Lock()
+        self.logs, self.max_size, self.size = defaultdict(list), max_size, 0
+        self.thread, self.unreachable = None, False
+
+    def add(self, runtime, key, log):
+        with self.lock:
+            self.logs[(runtime, key)].append(log)
+            self.size += 1
+            if not self.thread or not self.thread.is_alive():
+                self.thread = Thread(target=self.run_flusher, daemon=True)
+                self.thread.start()
+            full = self.size >= self.max_size and not self.unreachable
+        if full:
+            self.flush()
+
+    def discard(self, runtime):
+        with self.lock:
+            for key in [key for key in self.logs if key[0] == runtime]:
+                self.size -= len(self.logs.pop(key))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                logs, self.logs, self.size = self.logs, defaultdict(list), 0
+            if not logs:
+                return
+            pipeline = self.redis_queue.pipeline(transaction=False)
+            for (runtime, key), lines in logs.items():
+                pipeline.rpush(key, *lines)
+                pipeline.sadd(f"{runtime}/keys", key)
+            try:
+                pipeline.execute(raise_on_error=False)
+                self.unreachable = False
+            except Exception as exc:
+                self.unreachable = True
+                with self.lock:
+                    for key, lines in logs.items():
+                        self.logs[key][:0] = lines
+                        self.size += len(lines)
+                error(f"Redis Queue Unreachable: {len(logs)} run logs kept ({exc})")
+
+    def read(self, runtime, key, start_line=0):
+        with self.flush_lock:
+            try:
+                pipeline = self.redis_queue.pipeline(transaction=True)
+                length, log = pipeline.llen(key).lrange(key, start_line, -1).execute()
+            except Exception as exc:
+                error(f"Redis Queue Unreachable ({exc})")
+                length, log = 0, []
+            with self.lock:
+                buffered_log = self.logs.get((runtime, key), [])
+                return log + buffered_log[max(start_line - length, 0) :]
+
+    def run_flusher(self):
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                error(f"Failed to flush run logs:\n{format_exc()}")
+
+
+class RunStateStore:
+    def __init__(self, redis_queue=None, states=None, flush_interval=0.5):
+        self.redis_queue, self.flush_interval = redis_queue, flush_interval
+        self.states = defaultdict(dict) if states is None else states
+        self.increments = defaultdict(int)
+        self.flush_lock, self.lock = Lock(), Lock()
+        self.operations = []
+        self.thread = None
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                operations, self.operations = self.operations, []
+                operations.extend(
+                    ("increment", *key, value) for key, value in self.increments.items()
+                )
+                self.increments.clear()
+            if not operations:
+                return
+            pipeline = self.redis_queue.pipeline(transaction=False)
+            for method, runtime, field, value in operations:
+                key = f"{runtime}/state"
+                if method == "increment":
+                    pipeline.hincrby(key, field, value)
+                elif method == "delete":
+                    pipeline.hdel(key, field)
+                elif method == "append":
+                    pipeline.rpush(f"{key}/{field}", value)
+                    pipeline.sadd(f"{runtime}/keys", f"{key}/{field}")
+                    pipeline.sadd(f"{runtime}/state_lists", field)
+                else:
+                    pipeline.hset(key, field, value)
+            try:
+                pipeline.execute(raise_on_error=False)
+            except Exception as exc:
+                error(
+                    f"Redis Queue Unreachable: {len(operations)} updates lost ({exc})"
+                )
+
+    def read(self, runtime):
+        if not self.redis_queue:
+            return self.states[runtime]
+        try:
+            data = self.redis_queue.hgetall(f"{runtime}/state") or {}
+            for field in self.redis_queue.smembers(f"{runtime}/state_lists") or []:
+                key = f"{runtime}/state/{field}"
+                data[field] = self.redis_queue.lrange(key, 0, -1) or []
+        except Exception as exc:
+            error(f"Redis Queue Unreachable ({exc})")
+            return {}
+        state = {}
+        for field, value in data.items():
+            inner_store, (*path, last_key) = state, field.split("/")
+            for key in path:
+                inner_store = inner_store.setdefault(key, {})
+            if value in ("False", "True"):
+                value = value == "True"
+            inner_store[last_key] = value
+        return state
+
+    def run_flusher(self):
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                error(f"Failed to flush run state updates:\n{format_exc()}")
+
+    def update_local_state(self, key, value, method=None):
+        *keys, last = key.split("/")
+        with self.lock:
+            store = self.states
+            for key in keys:
+                store = store.setdefault(key, {})
+            if not method:
+                store[last] = value
+            elif method == "increment":
+                store[last] = store.get(last, 0) + value
+            elif method == "delete":
+                store.pop(last, None)
+            else:
+                store.setdefault(last, []).append(value)
+
+    def write(self, runtime, field, value, method=None):
+        if not self.redis_queue:
+            return self.update_local_state(f"{runtime}/{field}", value, method)
+        with self.lock:
+            key = (runtime, field)
+            if method == "increment":
+                self.increments[key] += value
+            else:
+                if key in self.increments:
+                    increment = self.increments.pop(key)
+                    self.operations.append(("increment", *key, increment))
+                self.operations.append((method, runtime, field, value))
+            if not self.thread or not self.thread.is_alive():
+                self.thread = Thread(target=self.run_flusher, daemon=True)
+                self.thread.start()
+
+
+def encode_json(input, convert=str):
+    def rec(value):
+        if isinstance(value, dict):
+            return {rec(key): rec(value[key]) for key in list(value)}
+        elif isinstance(value, list):
+            return list(map(rec, value))
+        elif isinstance(value, float) and not isfinite(value):
+            return convert(value)
+        elif not isinstance(value, (int, str, bool, float, None.__class__)):
+            return convert(value)
+        else:
+            return value
+
+    options = OPT_PASSTHROUGH_DATACLASS | OPT_PASSTHROUGH_DATETIME
+    try:
+        data = or_dumps(input, default=str, option=options)
+        result = or_loads(data)
+        if result == input:
+            return result, data
+    except (JSONEncodeError, ValueError):
+        pass
+    result = rec(input)
+    return result, dumps(result, allow_nan=False).encode("utf-8")
+
+
+def compress(value, algorithm="zlib", level=6):
+    try:
+        data = or_dumps(value)
+        if or_loads(data) != value:
+            raise ValueError("JSON round trip is lossy")
+    except (JSONEncodeError, ValueError):
+        data = pickle_dumps(value)
+    if algorithm == "zstd":
+        try:
+            return ZstdCompressor(level=level).compress(data)
+        except NameError:
+            pass
+    return zlib_compress(data, level)
+
+
+def decompress(data):
+    if data.startswith(b"\x80"):
+        return pickle_loads(data)
+    elif data.startswith(b"\x28\xb5\x2f\xfd"):
+        data = ZstdDecompressor().decompress(data)
+    else:
+        data = zlib_decompress(data)
+    return pickle_loads(data) if data.startswith(b"\x80") else or_loads(data)
@@ -7,7 +7,7 @@ from passlib.hash import argon2
 from pathlib import Path
 from shutil import move, rmtree
 from signal import SIGTERM
-from sqlalchemy import Boolean, Float, ForeignKey, Integer
+from sqlalchemy import Boolean, event, Float, ForeignKey, Integer
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship
 from sqlalchemy.types import JSON
@@ -122,6 +122,14 @@ class User(AbstractBase, UserMixin):
     )
     logs = relationship("Changelog", back_populates="user")
 
+    @classmethod
+    def configure_events(cls):
+        @event.listens_for(cls.groups, "append")
+        @event.listens_for(cls.groups, "remove")
+        @event.listens_for(cls.is_admin, "set")
+        def invalidate_allowed_targets(target, *args):
+            env.allowed_targets.invalidate(target.name)
+
     @classmethod
     def database_init(cls):
         for property in vs.rbac["form_properties"]:
@@ -174,6 +182,13 @@ class Group(AbstractBase):
     users = relationship("User", secondary=db.user_group_table, back_populates="groups")
     logs = relationship("Changelog", back_populates="group")
 
+    @classmethod
+    def configure_events(cls):
+        @event.listens_for(cls, "after_update")
+        @event.listens_for(cls, "after_delete")
+        def invalidate_allowed_targets(mapper, connection, target):
+            env.allowed_targets.invalidate()
+
     @classmethod
     def database_init(cls):
         for property in vs.rbac["form_properties"]:
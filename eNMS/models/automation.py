@@ -8,17 +8,17 @@ from orjson import loads
 from os import environ, getpid
 from requests import get, post
 from requests.exceptions import ConnectionError, MissingSchema, ReadTimeout
-from sqlalchemy import Boolean, case, ForeignKey, insert, Integer
+from sqlalchemy import Boolean, case, event, ForeignKey, insert, Integer, update
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref, deferred, relationship
-from threading import Thread
+from threading import Event, Thread
 from time import perf_counter
 from traceback import format_exc
-from types import SimpleNamespace
+from types import MappingProxyType, SimpleNamespace
 
 from eNMS.controller import controller
-from eNMS.database import db
+from eNMS.database import build_record, db
 from eNMS.environment import env
 from eNMS.models.base import AbstractBase
 from eNMS.runner import Runner
@@ -102,6 +102,7 @@ class Service(AbstractBase):
     iteration_variable_name = db.Column(db.SmallString, default="iteration_value")
     iteration_devices = db.Column(db.LargeString)
     iteration_devices_property = db.Column(db.TinyString, default="ip_address")
+    iteration_max_concurrency = db.Column(Integer, default=1)
     preprocessing = db.Column(db.LargeString)
     postprocessing = db.Column(db.LargeString)
     postprocessing_mode = db.Column(db.TinyString, default="success")
@@ -125,7 +126,9 @@ class Service(AbstractBase):
     )
     maximum_runs = db.Column(Integer, default=1)
     multiprocessing = db.Column(Boolean, default=False)
+    multiprocessing_mode = db.Column(db.TinyString, default="thread")
     max_processes = db.Column(Integer, default=5)
+    adaptive_concurrency = db.Column(Boolean, default=False)
     status = db.Column(db.TinyString, default="Idle")
     validation_condition = db.Column(db.TinyString, default="none")
     conversion_method = db.Column(db.TinyString, default="none")
@@ -165,6 +168,13 @@ class Service(AbstractBase):
         ):
             raise db.rbac_error("Not Authorized (restricted to owners).")
 
+    @classmethod
+    def configure_events(cls):
+        @event.listens_for(cls, "after_update", propagate=True)
+        @event.listens_for(cls, "after_delete", propagate=True)
+        def invalidate_topology(mapper, connection, target):
+            env.topology_cache.invalidate(target.id)
+
     def delete(self):
         if self.name in ("[Shared] Start", "[Shared] End", "[Shared] Placeholder"):
             return {"log": f"It is not allowed to delete '{self.name}'."}
@@ -292,7 +302,7 @@ class Result(AbstractBase):
     labels = db.Column(db.LargeString)
     runtime = db.Column(db.TinyString)
     duration = db.Column(db.TinyString)
-    result = deferred(db.Column(db.Dict))
+    result = deferred(db.Column(db.CompressedDict))
     creator = db.Column(db.SmallString)
     memory_size = db.Column(db.SmallString)
     run_id = db.Column(Integer, ForeignKey("run.id", ondelete="cascade"))
@@ -403,6 +413,10 @@ class Run(AbstractBase):
     path = db.Column(db.TinyString)
     memory_size = db.Column(db.SmallString)
     parameterized_run = db.Column(Boolean, default=False)
+    progress_total = db.Column(Integer)
+    progress_success = db.Column(Integer)
+    progress_failure = db.Column(Integer)
+    progress_skipped = db.Column(Integer)
     server_id = db.Column(Integer, ForeignKey("server.id"))
     server = relationship("Server", back_populates="runs")
     server_name = association_proxy("server", "name")
@@ -428,7 +442,7 @@ class Run(AbstractBase):
     worker_id = db.Column(Integer, ForeignKey("worker.id"))
     worker = relationship("Worker", back_populates="runs")
     worker_name = association_proxy("worker", "name")
-    state = db.Column(db.Dict, info={"log_change": False})
+    state = deferred(db.Column(db.Dict, info={"log_change": False}))
     results = relationship("Result", back_populates="run", cascade="all, delete-orphan")
     model_properties = {
         "progress": "str",
@@ -493,42 +507,54 @@ class Run(AbstractBase):
 
         return decorator
 
-    @property
-    def cache(self):
+    def build_cache(self):
         creator = db.fetch("user", name=self.creator, rbac=None)
-        return {
-            "creator": {
+        user = MappingProxyType(
+            {
                 "name": creator.name,
                 "email": creator.email,
                 "is_admin": creator.is_admin,
-            },
-            "main_run": self.base_properties,
-            "main_run_service": {
-                "credential_type": self.service.credential_type,
-                "high_performance": self.service.high_performance,
-                "log_level": int(self.service.log_level),
-                "show_user_logs": self.service.show_user_logs,
-                "id": self.service.id,
-            },
-            "topology": self.topology,
-            "global_variables": {
-                "dict_to_string": vs.dict_to_string,
-                "encrypt": env.encrypt_password,
-                "placeholder": self.topology["services"].get(self.placeholder_id),
-                "prepend_filepath": vs.prepend_filepath,
-                "runtime": self.runtime,
-                "send_email": env.send_email,
-                "server": vs.server_dict,
-                "trigger": self.trigger,
-                "try_commit": db.try_commit,
-                "try_set": db.try_set,
-                "user": {
-                    "name": creator.name,
-                    "email": creator.email,
-                    "is_admin": creator.is_admin,
-                },
-            },
-        }
+            }
+        )
+        return MappingProxyType(
+            {
+                "creator": user,
+                "main_run": MappingProxyType(self.base_properties),
+                "main_run_service": MappingProxyType(
+                    {
+                        "credential_type": self.service.credential_type,
+                        "high_performance": self.service.high_performance,
+                        "log_level": int(self.service.log_level),
+                        "show_user_logs": self.service.show_user_logs,
+                        "id": self.service.id,
+                    }
+                ),
+                "topology": self.topology,
+                "global_variables": MappingProxyType(
+                    {
+                        "dict_to_string": vs.dict_to_string,
+                        "encrypt": env.encrypt_password,
+                        "placeholder": self.topology["services"].get(
+                            self.placeholder_id
+                        ),
+                        "prepend_filepath": vs.prepend_filepath,
+                        "runtime": self.runtime,
+                        "send_email": env.send_email,
+                        "server": vs.server_dict,
+                        "trigger": self.trigger,
+                        "try_commit": db.try_commit,
+                        "try_set": db.try_set,
+                        "user": user,
+                    }
+                ),
+            }
+        )
+
+    @property
+    def cache(self):
+        if self.runtime not in vs.run_contexts:
+            vs.run_contexts[self.runtime] = self.build_cache()
+        return vs.run_contexts[self.runtime]
 
     @process()
     def clean_stored_data(self):
@@ -537,10 +563,22 @@ class Run(AbstractBase):
         vs.run_logs.pop(self.runtime, None)
         vs.run_stop.pop(self.runtime, None)
         vs.run_instances.pop(self.runtime, None)
+        vs.run_branch_slots.pop(self.runtime, None)
+        vs.run_credentials.pop(self.runtime, None)
+        vs.run_contexts.pop(self.runtime, None)
+        vs.run_templates.pop(self.runtime, None)
         if env.redis_queue:
-            runtime_keys = env.redis("keys", f"{self.runtime}/*") or []
-            if runtime_keys:
-                env.redis("delete", *runtime_keys)
+            env.run_log_buffer.discard(self.runtime)
+            runtime_keys = [
+                *(env.redis("smembers", f"{self.runtime}/keys") or []),
+                *(env.redis("smembers", f"{self.runtime}/results") or []),
+            ]
+            if not runtime_keys:
+                pattern = f"{self.runtime}/*"
+                runtime_keys = list(env.redis("scan_iter", match=pattern) or [])
+            for key in ("keys", "results", "services", "state", "state_lists"):
+                runtime_keys.append(f"{self.runtime}/{key}")
+            env.redis("delete", *runtime_keys)
             env.redis("decr", f"rate_limit:{self.creator}:runs")
 
     @process()
@@ -551,7 +589,7 @@ class Run(AbstractBase):
             for device, connections in list(device_connections.items()):
                 for connection in list(connections.values()):
                     args = (library, device, connection)
-                    thread = Thread(target=self.runner.disconnect, args=args)
+                    thread = Thread(target=self.runner.release_connection, args=args)
                     thread.start()
                     threads.append(thread)
         timeout = vs.automation["advanced"]["disconnect_thread_timeout"]
@@ -599,7 +637,7 @@ class Run(AbstractBase):
                 loads(result)
                 for result in chain.from_iterable(
                     env.redis("lrange", key, 0, -1)
-                    for key in env.redis("keys", f"{self.runtime}/results/*")
+                    for key in env.redis("smembers", f"{self.runtime}/results") or []
                 )
             )
         else:
@@ -633,6 +671,8 @@ class Run(AbstractBase):
             self.service.status = "Idle"
         state = self.get_state()
         self.memory_size = state.get("memory_size", "Unknown")
+        for property, value in self.get_progress().items():
+            setattr(self, property, value)
         self.state = state
         if self.task and not (self.task.frequency or self.task.crontab_expression):
             self.task.is_active = False
@@ -674,29 +714,15 @@ class Run(AbstractBase):
                 devices |=self.runner.compute_devices_from_query(query, property)
         self.target_devices, self.target_pools = list(devices), list(pools)
         db.session.commit()
-        return set(devices) | set().union(*(pool.devices for pool in pools))
+        device_ids = db.get_pool_device_ids(pool.id for pool in pools)
+        device_ids -= {device.id for device in devices}
+        return set(devices) | self.runner.fetch_devices(device_ids)
 
     def get_state(self):
-        if self.state:
-            return self.state
-        elif env.redis_queue:
-            keys = env.redis("keys", f"{self.runtime}/state/*")
-            if not keys:
-                return {}
-            data, state = list(zip(keys, env.redis("mget", *keys))), {}
-            for log, value in data:
-                inner_store, (*path, last_key) = state, log.split("/")[2:]
-                for key in path:
-                    inner_store = inner_store.setdefault(key, {})
-                if value in ("False", "True"):
-                    value = value == "True"
-                inner_store[last_key] = value
-            return state
-        else:
-            return vs.run_states[self.runtime]
+        return self.state or env.run_state_store.read(self.runtime)
 
     @process(raise_exception=True)
-    def get_topology(self):
+    def build_topology(self, compiled):
         self.topology = {
             "devices": {},
             "pools": {},
@@ -704,7 +730,38 @@ class Run(AbstractBase):
             "edges": {},
             "name_to_dict": defaultdict(dict),
             "scoped_name_to_dict": {},
+            "neighbors": defaultdict(set, compiled["neighbors"]),
+        }
+        targets = {}
+        for model in ("device", "pool"):
+            ids = set(chain.from_iterable(compiled[f"target_{model}s"].values()))
+            targets[model] = {}
+            for batch in batched(ids, vs.database["transactions"]["batch_size"]):
+                for instance in db.fetch_all(model, id_in=batch):
+                    targets[model][instance.id] = instance
+        for service_id, properties in compiled["services"].items():
+            properties = dict(properties)
+            for model in ("device", "pool"):
+                target_ids = compiled[f"target_{model}s"][service_id]
+                properties[f"target_{model}s"] = [
+                    targets[model][id] for id in target_ids if id in targets[model]
+                ]
+            service = build_record(properties["type"], properties)
+            self.topology["services"][service_id] = service
+            self.topology["scoped_name_to_dict"][service.scoped_name] = service
+            self.topology["name_to_dict"]["services"][service.name] = service
+        for edge_id, properties in compiled["edges"].items():
+            edge = SimpleNamespace(**properties)
+            self.topology["edges"][edge_id] = edge
+            self.topology["name_to_dict"]["edges"][edge.name] = edge
+
+    def compile_topology(self):
+        topology = {
+            "services": {},
+            "edges": {},
             "neighbors": defaultdict(set),
+            "target_devices": {},
+            "target_pools": {},
         }
         instances, visited = {self.service}, set()
         while instances:
@@ -715,29 +772,40 @@ class Run(AbstractBase):
                 instance = self.placeholder
             visited.add(instance)
             if instance.type == "workflow_edge":
-                edge = SimpleNamespace(**instance.get_properties())
-                self.topology["edges"][instance.id] = edge
+                topology["edges"][instance.id] = instance.get_properties()
                 source_id, destination_id = instance.source_id, instance.destination_id
                 if instance.source.name == "[Shared] Placeholder":
                     source_id = self.placeholder.id
                 elif instance.destination.name == "[Shared] Placeholder":
                     destination_id = self.placeholder.id
                 key = (instance.workflow_id, source_id)
-                self.topology["neighbors"][key].add((edge.id, destination_id))
-                self.topology["name_to_dict"]["edges"][instance.name] = edge
+                topology["neighbors"][key].add((instance.id, destination_id))
             else:
-                service = SimpleNamespace(
-                    **instance.get_properties(
-                        exclude=["positions"], private_properties=True
-                    )
+                topology["services"][instance.id] = instance.get_properties(
+                    exclude=["positions"], private_properties=True
                 )
-                service.target_devices = instance.target_devices
-                service.target_pools = instance.target_pools
-                self.topology["services"][instance.id] = service
-                self.topology["scoped_name_to_dict"][instance.scoped_name] = service
-                self.topology["name_to_dict"]["services"][instance.name] = service
+                for model in ("device", "pool"):
+                    topology[f"target_{model}s"][instance.id] = [
+                        target.id for target in getattr(instance, f"target_{model}s")
+                    ]
             if instance.type == "workflow":
                 instances |= set(instance.services) | set(instance.edges)
+        topology["neighbors"] = {
+            key: frozenset(neighbors)
+            for key, neighbors in topology["neighbors"].items()
+        }
+        return topology
+
+    def get_topology(self):
+        services = (self.service, self.placeholder)
+        key = "/".join(
+            f"{service.id}-{service.last_modified}" for service in services if service
+        )
+        compiled = env.topology_cache.get(key)
+        if not compiled:
+            compiled = self.compile_topology()
+            env.topology_cache.set(key, compiled)
+        self.build_topology(compiled)
 
     def post_process_results(self, results):
         if self.trigger == "REST API" and self.service.high_performance:
@@ -748,8 +816,29 @@ class Run(AbstractBase):
                 results["devices"][result.device.name] = result.result
         return results
 
+    def get_progress(self, runtime=None, path=None):
+        runtime, path = runtime or self.runtime, path or self.service.persistent_id
+        counters = ("total", "success", "failure", "skipped")
+        if env.redis_queue:
+            fields = (f"{path}/progress/device/{counter}" for counter in counters)
+            values = env.redis("hmget", f"{runtime}/state", *fields) or []
+        else:
+            state = vs.run_states.get(runtime, {}).get(path, {})
+            progress = state.get("progress", {}).get("device", {})
+            values = [progress.get(counter) for counter in counters]
+        return {
+            f"progress_{counter}": int(value)
+            for counter, value in zip(counters, values)
+            if value is not None
+        }
+
     @property
     def progress(self):
+        if self.progress_total is not None:
+            failure, success = self.progress_failure or 0, self.progress_success or 0
+            return f"{success + failure}/{self.progress_total} ({failure} failed)"
+        elif self.status == "Running":
+            return
         progress = self.get_state().get(self.service.persistent_id, {}).get("progress")
         if not progress:
             return
@@ -762,7 +851,12 @@ class Run(AbstractBase):
             return "N/A"
 
     def run(self):
-        start_time = datetime.now()
+        start_time, progress_sync = datetime.now(), Event()
+        Thread(
+            target=self.sync_progress,
+            args=(self.id, self.runtime, self.service.persistent_id, progress_sync),
+            daemon=True,
+        ).start()
         try:
             results = self.start_run()
         except Exception:
@@ -772,10 +866,20 @@ class Run(AbstractBase):
                 self.runner.log("critical", log)
             else:
                 env.log_queue(self.runtime, self.service.id, log)
+        finally:
+            progress_sync.set()
         results["duration"] = str(datetime.now() - start_time)
         return self.run_finalize(results)
 
     def run_finalize(self, results, app_reloaded=False):
+        env.result_writer.flush()
+        if lost_results := env.result_writer.pop_failures(self.runtime):
+            log = f"{lost_results} results could not be written to the database"
+            env.log_queue(self.runtime, self.service.id, log)
+            results["success"] = False
+        if env.redis_queue:
+            env.run_log_buffer.flush()
+            env.run_state_store.flush()
         self.run_service_table_transaction()
         if self.service.high_performance:
             self.create_all_results()
@@ -823,19 +927,22 @@ class Run(AbstractBase):
             commit=True,
         )
         self.worker = worker
-        vs.run_allowed_targets[self.runtime] = set(
-            device.id
-            for device in controller.filtering(
-                "device", properties=["id"], rbac="target", user=self.creator
-            )
+        vs.run_allowed_targets[self.runtime] = env.allowed_targets.get(
+            self.creator,
+            lambda: (
+                device.id
+                for device in controller.filtering(
+                    "device", properties=["id"], rbac="target", user=self.creator
+                )
+            ),
         )
         self.service.update_count(1)
         if not self.trigger:
             run_type = "Parameterized" if self.parameterized_run else "Regular"
             self.trigger = f"{run_type} Run"
         self.get_topology()
+        vs.run_contexts[self.runtime] = self.build_cache()
         kwargs = {
-            "cache": self.cache,
             "payload": deepcopy(self.payload),
             "is_main_run": True,
             "parameterized_run": self.parameterized_run,
@@ -851,7 +958,6 @@ class Run(AbstractBase):
             main_run = SimpleNamespace(**self.get_properties())
             main_run.target_devices, main_run.target_pools = None, None
             main_run.restart_run = self.restart_run
-            main_run.cache = kwargs["cache"]
             main_run.service = self.topology["services"][self.service_id]
             main_run.placeholder = self.topology["services"].get(self.placeholder_id)
             self.update_target_pools()
@@ -865,6 +971,23 @@ class Run(AbstractBase):
             self.runner.run_targets = self.get_run_targets()
         return self.runner.start_run()
 
+    def sync_progress(self, run_id, runtime, path, stop):
+        progress = {}
+        while not stop.wait(vs.automation["run_progress"]["sync_interval"]):
+            new_progress = self.get_progress(runtime, path)
+            if not new_progress or new_progress == progress:
+                continue
+            progress = new_progress
+            try:
+                with db.session_scope(commit=True, remove=True):
+                    db.session.execute(
+                        update(vs.models["run"])
+                        .where(vs.models["run"].id == run_id)
+                        .values(**progress)
+                    )
+            except Exception:
+                env.log("error", f"Failed to sync run progress:\n{format_exc()}")
+
     def table_properties(self, **kwargs):
         return {"url": self.service.builder_link, **super().table_properties(**kwargs)}
 
@@ -6,6 +6,7 @@ from sqlalchemy.schema import UniqueConstraint
 
 from eNMS.controller import controller
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.models.base import AbstractBase
 from eNMS.variables import vs
 
@@ -52,6 +53,7 @@ class Device(Object):
     os_version = db.Column(db.SmallString)
     ip_address = db.Column(db.TinyString, index=True)
     port = db.Column(Integer, default=22)
+    max_sessions = db.Column(Integer, default=0)
     netmiko_driver = db.Column(db.TinyString, default="cisco_ios")
     napalm_driver = db.Column(db.TinyString, default="ios")
     scrapli_driver = db.Column(db.TinyString, default="cisco_iosxe")
@@ -87,6 +89,13 @@ class Device(Object):
     def __repr__(self):
         return f"{self.name} ({self.model})" if self.model else str(self.name)
 
+    @classmethod
+    def configure_events(cls):
+        @event.listens_for(cls, "after_insert", propagate=True)
+        @event.listens_for(cls, "after_delete", propagate=True)
+        def invalidate_allowed_targets(mapper, connection, target):
+            env.allowed_targets.invalidate()
+
     @classmethod
     def database_init(cls):
         for property in vs.configuration_properties:
@@ -300,9 +309,15 @@ class Pool(AbstractBase):
             db.try_commit(transaction)
         else:
             transaction()
+        env.allowed_targets.invalidate()
 
     @classmethod
     def configure_events(cls):
+        @event.listens_for(cls, "after_update")
+        @event.listens_for(cls, "after_delete")
+        def invalidate_allowed_targets(mapper, connection, target):
+            env.allowed_targets.invalidate()
+
         for model in cls.models:
 
             @event.listens_for(getattr(cls, f"{model}s"), "append")
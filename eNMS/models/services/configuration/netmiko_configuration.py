@@ -1,8 +1,8 @@
-from jinja2 import StrictUndefined, Template
 from sqlalchemy import Boolean, Float, ForeignKey, Integer
 from wtforms.widgets import TextArea
 
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.fields import BooleanField, HiddenField, StringField
 from eNMS.forms import NetmikoForm
 from eNMS.models.automation import ConnectionService
@@ -36,8 +36,8 @@ class NetmikoConfigurationService(ConnectionService):
     def job(self, run, device):
         local_variables = locals()
         if self.jinja2_template:
-            config = Template(run.content, undefined=StrictUndefined).render(
-                {**local_variables, **run.global_variables(**local_variables)}
+            config = env.get_jinja2_template(run.content, strict=True).render(
+                {**local_variables, **run.template_variables(**local_variables)}
             )
         else:
             config = run.sub(run.content, local_variables)
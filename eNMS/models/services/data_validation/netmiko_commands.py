@@ -1,9 +1,9 @@
-from jinja2 import StrictUndefined, Template
 from sqlalchemy import Boolean, Float, ForeignKey, Integer
 from traceback import format_exc
 from wtforms.widgets import TextArea
 
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.fields import BooleanField, HiddenField, StringField
 from eNMS.forms import NetmikoForm
 from eNMS.models.automation import ConnectionService
@@ -47,8 +47,8 @@ class NetmikoValidationService(ConnectionService):
     def job(self, run, device):
         local_variables = locals()
         if self.jinja2_template:
-            commands = Template(run.commands, undefined=StrictUndefined).render(
-                {**local_variables, **run.global_variables(**local_variables)}
+            commands = env.get_jinja2_template(run.commands, strict=True).render(
+                {**local_variables, **run.template_variables(**local_variables)}
             )
         else:
             commands = run.sub(run.commands, local_variables)
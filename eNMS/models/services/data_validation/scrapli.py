@@ -1,8 +1,8 @@
-from jinja2 import StrictUndefined, Template
 from sqlalchemy import Boolean, Float, ForeignKey, Integer
 from wtforms.widgets import TextArea
 
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.fields import BooleanField, HiddenField, StringField
 from eNMS.forms import ScrapliForm
 from eNMS.models.automation import ConnectionService
@@ -27,25 +27,44 @@ class ScrapliService(ConnectionService):
 
     @staticmethod
     def job(self, run, device):
+        commands, log_commands = ScrapliService.get_commands(self, run, device)
+        if run.dry_run:
+            return {"commands": log_commands}
+        function = "send_configs" if run.is_configuration else "send_commands"
+        multi_response = getattr(run.scrapli_connection(device), function)(commands)
+        return ScrapliService.get_results(self, commands, log_commands, multi_response)
+
+    @staticmethod
+    async def async_job(self, run, device):
+        commands, log_commands = ScrapliService.get_commands(self, run, device)
+        if run.dry_run:
+            return {"commands": log_commands}
+        function = "send_configs" if run.is_configuration else "send_commands"
+        connection = await run.async_scrapli_connection(device)
+        multi_response = await getattr(connection, function)(commands)
+        return ScrapliService.get_results(self, commands, log_commands, multi_response)
+
+    @staticmethod
+    def get_commands(self, run, device):
         local_variables = locals()
         if self.jinja2_template:
-            commands = Template(run.commands, undefined=StrictUndefined).render(
-                {**locals(), **run.global_variables(**local_variables)}
+            commands = env.get_jinja2_template(run.commands, strict=True).render(
+                {**locals(), **run.template_variables(**local_variables)}
             )
         else:
             commands = run.sub(run.commands, local_variables)
         log_commands = run.safe_log(run.commands, commands)
-        commands = commands.splitlines()
-        if run.dry_run:
-            return {"commands": log_commands}
-        function = "send_configs" if run.is_configuration else "send_commands"
-        run.log(
-            "info",
-            f"sending COMMANDS '{log_commands}' with Scrapli",
-            device,
-            logger="security",
-        )
-        multi_response = getattr(run.scrapli_connection(device), function)(commands)
+        if not run.dry_run:
+            run.log(
+                "info",
+                f"sending COMMANDS '{log_commands}' with Scrapli",
+                device,
+                logger="security",
+            )
+        return commands.splitlines(), log_commands
+
+    @staticmethod
+    def get_results(self, commands, log_commands, multi_response):
         if self.results_as_list:
             result = [response.result for response in multi_response]
         elif len(commands) == 1:
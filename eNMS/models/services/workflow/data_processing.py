@@ -1,5 +1,4 @@
 from io import StringIO
-from jinja2 import Template
 from json import loads
 from re import findall
 from sqlalchemy import ForeignKey, Integer
@@ -13,6 +12,7 @@ except ImportError as exc:
     warn(f"Couldn't import ttp module ({exc})")
 
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.fields import HiddenField, SelectField, StringField
 from eNMS.forms import ServiceForm
 from eNMS.models.automation import Service
@@ -67,7 +67,7 @@ class DataProcessingService(Service):
                 if match_type == "textfsm_dict":
                     value = [dict(zip(template.header, row)) for row in value]
             elif match_type == "jinja2":
-                template = Template(match)
+                template = env.get_jinja2_template(match)
                 value = template.render(value)
             elif match_type == "ttp":
                 parser = ttp(data=value, template=match)
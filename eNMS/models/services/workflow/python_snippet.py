@@ -3,6 +3,7 @@ from traceback import extract_tb, format_exc
 from wtforms.widgets import TextArea
 
 from eNMS.database import db
+from eNMS.environment import env
 from eNMS.fields import HiddenField, StringField
 from eNMS.forms import ServiceForm
 from eNMS.models.automation import Service
@@ -20,7 +21,9 @@ class PythonSnippetService(Service):
     @staticmethod
     def job(self, run, device=None):
         try:
-            code_object = compile(run.source_code, "user_python_code", "exec")
+            code_object = env.code_cache.compile(
+                run.source_code, "exec", self, "user_python_code"
+            )
         except Exception as exc:
             run.log("error", f"Compile error: {str(exc)}")
             return {"success": False, "result": {"step": "compile", "error": str(exc)}}
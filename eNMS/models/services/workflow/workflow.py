@@ -1,8 +1,10 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from heapq import heappop, heappush
 from sqlalchemy import Boolean, ForeignKey, Integer
 from sqlalchemy.orm import backref, deferred, relationship
 from sqlalchemy.schema import UniqueConstraint
+from threading import BoundedSemaphore
 from wtforms.validators import NumberRange
 
 from eNMS.database import db
@@ -27,6 +29,8 @@ class Workflow(Service):
     id = db.Column(Integer, ForeignKey("service.id"), primary_key=True)
     category = db.Column(db.SmallString)
     close_connection = db.Column(Boolean, default=False)
+    concurrent_branches = db.Column(Boolean, default=False)
+    max_concurrent_branches = db.Column(Integer, default=5)
     labels = db.Column(db.Dict, info={"log_change": False})
     positions = deferred(db.Column(db.Dict, default={}, info={"log_change": False}))
     man_minutes_type = db.Column(db.TinyString, default="workflow")
@@ -170,45 +174,63 @@ class Workflow(Service):
         tracking_bfs = run.run_method == "per_service_with_workflow_targets"
         SxS = not (tracking_bfs or device)
         device_store = {device.name: device for device in start_targets}
-        while services:
-            if run.stop:
-                return {"success": False, "result": "Aborted"}
-            _, service_id = heappop(services)
-            service = topology["services"][service_id]
-            if number_of_runs[service.name] >= service.maximum_runs:
-                continue
-            number_of_runs[service.name] += 1
-            visited.add(service_id)
-            if service in (start, end) or service.skip.get(self.name, False):
-                success = service.skip_value == "success"
-                results = {"result": "skipped", "success": success}
-                if not SxS:
-                    results["summary"] = defaultdict(
-                        list, success=targets[service.name]
+        concurrency = self.max_concurrent_branches if self.concurrent_branches else 1
+        if concurrency > 1:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            run_slots = vs.automation["workflow"]["max_concurrent_branches"]
+            slots = vs.run_branch_slots.setdefault(
+                run.parent_runtime, BoundedSemaphore(run_slots)
+            )
+        in_flight = {}
+        parent_ids = {
+            "workflow": self.id,
+            "main_run": run.main_run.id,
+            "parent_device": getattr(run.parent_device, "id", None),
+        }
+
+        def start_service_run(service_id, run_targets, parent_ids=None):
+            service_kw, workflow = topology["services"][service_id], self
+            main_run, parent_device = run.main_run, run.parent_device
+            if not run.high_performance:
+                service_kw = db.fetch("service", id=service_id, rbac=None)
+                if parent_ids:
+                    workflow = db.fetch(
+                        "workflow", id=parent_ids["workflow"], rbac=None
                     )
-            else:
-                service_kw = service
-                if not run.high_performance:
-                    service_kw = db.fetch("service", id=service_id, rbac=None)
-                kwargs = {
-                    "service": service_kw,
-                    "workflow": self,
-                    "parent": run,
-                    "parent_runtime": run.parent_runtime,
-                    "workflow_run_method": run.run_method,
-                }
-                if not SxS:
-                    kwargs["run_targets"] = []
-                    for name in targets[service.name]:
-                        if name not in device_store:
-                            device_store[name] = db.fetch("device", name=name)
-                        kwargs["run_targets"].append(device_store[name])
-                if run.parent_device:
-                    kwargs["parent_device"] = run.parent_device
-                service_run = Runner(run, payload=run.payload, **kwargs)
-                results = service_run.start_run()
-                if not results:
-                    continue
+                    main_run = db.fetch("run", id=parent_ids["main_run"], rbac=None)
+                    if parent_device:
+                        parent_device = db.fetch(
+                            "device", id=parent_ids["parent_device"], rbac=None
+                        )
+                    if run_targets is not None:
+                        target_ids = [device.id for device in run_targets]
+                        run_targets = db.fetch_all(
+                            "device", id_in=target_ids, rbac=None
+                        )
+            kwargs = {
+                "service": service_kw,
+                "workflow": workflow,
+                "main_run": main_run,
+                "parent": run,
+                "parent_runtime": run.parent_runtime,
+                "workflow_run_method": run.run_method,
+            }
+            if run_targets is not None:
+                kwargs["run_targets"] = run_targets
+            if parent_device:
+                kwargs["parent_device"] = parent_device
+            return Runner(run, payload=run.payload, **kwargs).start_run()
+
+        def start_service_run_in_thread(service_id, run_targets, parent_ids):
+            try:
+                with db.session_scope(commit=True, remove=True):
+                    return start_service_run(service_id, run_targets, parent_ids)
+            finally:
+                slots.release()
+
+        def process_results(service_id, results):
+            if not results:
+                return
             status = "success" if results["success"] else "failure"
             next_edge = results.get("outgoing_edge", status)
             summary = results.get("summary", {})
@@ -225,6 +247,65 @@ class Workflow(Service):
                 heappush(services, ((1 / successor.priority, successor.id)))
                 edge_state = ("Done",) if SxS else (len(next_targets), "increment")
                 run.write_state(f"edges/{edge_id}", *edge_state, top_level=True)
+
+        try:
+            while services or in_flight:
+                if run.stop:
+                    return {"success": False, "result": "Aborted"}
+                postponed = []
+                while services and len(in_flight) < concurrency:
+                    entry = heappop(services)
+                    service_id = entry[1]
+                    if service_id in in_flight.values():
+                        postponed.append(entry)
+                        continue
+                    service = topology["services"][service_id]
+                    if number_of_runs[service.name] >= service.maximum_runs:
+                        continue
+                    if service in (start, end) or service.skip.get(self.name, False):
+                        number_of_runs[service.name] += 1
+                        visited.add(service_id)
+                        success = service.skip_value == "success"
+                        results = {"result": "skipped", "success": success}
+                        if not SxS:
+                            results["summary"] = defaultdict(
+                                list, success=targets[service.name]
+                            )
+                        process_results(service_id, results)
+                        continue
+                    run_targets = None
+                    if not SxS:
+                        run_targets = []
+                        for name in targets[service.name]:
+                            if name not in device_store:
+                                device_store[name] = db.fetch("device", name=name)
+                            run_targets.append(device_store[name])
+                    in_thread = concurrency > 1 and slots.acquire(blocking=False)
+                    if not in_thread and in_flight:
+                        postponed.append(entry)
+                        break
+                    number_of_runs[service.name] += 1
+                    visited.add(service_id)
+                    if in_thread:
+                        future = executor.submit(
+                            start_service_run_in_thread,
+                            service_id,
+                            run_targets,
+                            parent_ids,
+                        )
+                        in_flight[future] = service_id
+                    else:
+                        results = start_service_run(service_id, run_targets)
+                        process_results(service_id, results)
+                for entry in postponed:
+                    heappush(services, entry)
+                if in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        process_results(in_flight.pop(future), future.result())
+        finally:
+            if concurrency > 1:
+                executor.shutdown(wait=True)
         if SxS:
             results = {"success": end.id in visited}
         else:
@@ -238,6 +319,12 @@ class WorkflowForm(ServiceForm):
     form_type = HiddenField(default="workflow")
     category = SelectField("Category")
     close_connection = BooleanField(default=False)
+    concurrent_branches = BooleanField(
+        "Run Branches Concurrently", help="workflow/concurrent_branches"
+    )
+    max_concurrent_branches = IntegerField(
+        "Maximum number of concurrent branches", [NumberRange(min=1)], default=5
+    )
     run_method = SelectField(
         "Run Method",
         choices=(
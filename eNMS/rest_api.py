@@ -53,6 +53,9 @@ class RestApi(vs.TimingMixin):
                 "result": result.result if result else "No results yet.",
             }
 
+    def get_job_executor_statistics(self, **_):
+        return env.job_executor.statistics
+
     def get_workers(self):
         return env.get_workers()
 
@@ -1,34 +1,48 @@
+from asyncio import (
+    gather,
+    get_running_loop,
+    run as asyncio_run,
+    Semaphore,
+    sleep as async_sleep,
+)
 from builtins import __dict__ as builtins
-from collections import defaultdict
+from collections import ChainMap, defaultdict
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
+from hashlib import sha256
 from importlib import __import__ as importlib_import
 from io import BytesIO, StringIO
-from jinja2 import Template
-from json import dump, load, loads
+from itertools import batched
+from math import inf
+from json import dump, dumps, load, loads
 from json.decoder import JSONDecodeError
+from multiprocessing import get_context
 from multiprocessing.pool import ThreadPool
 from netmiko import ConnectHandler
 from operator import attrgetter
 from orjson import dumps as or_dumps, loads as or_loads
 from os import getenv
 from paramiko import AutoAddPolicy, RSAKey, SFTPClient, SSHClient
+from queue import SimpleQueue
 from re import compile, search
 from requests import post
 from scp import SCPClient
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import load_only, selectinload
 from sys import getsizeof
-from time import sleep
+from threading import Condition, local
+from time import monotonic, sleep
 from traceback import format_exc
-from types import GeneratorType, SimpleNamespace
+from types import GeneratorType, MappingProxyType, SimpleNamespace
 from warnings import warn
 from xmltodict import parse
 from xml.parsers.expat import ExpatError
 
 try:
-    from scrapli import Scrapli
+    from scrapli import AsyncScrapli, Scrapli
     from scrapli_netconf.driver import NetconfDriver
 except ImportError as exc:
     warn(f"Couldn't import scrapli module ({exc})")
@@ -49,10 +63,67 @@ except ImportError as exc:
     warn(f"Couldn't import napalm module ({exc})")
 
 from eNMS.controller import controller
-from eNMS.database import db
+from eNMS.database import db, Record
 from eNMS.environment import env
+from eNMS.helpers import encode_json, ReadOnlyDict
 from eNMS.variables import vs
 
+SUBSTITUTION_REGEX = compile("{{(.*?)}}")
+
+
+class AdaptiveConcurrency:
+    def __init__(self, maximum, callback=None):
+        settings = vs.automation["adaptive_concurrency"]
+        self.maximum, self.callback = maximum, callback
+        self.limit = float(max(1, min(settings["initial"], maximum)))
+        self.backoff_factor = settings["backoff_factor"]
+        self.latency_factor = settings["latency_factor"]
+        self.congestion_errors = [
+            pattern.lower() for pattern in settings["congestion_errors"]
+        ]
+        self.condition = Condition()
+        self.running, self.average_duration, self.last_decrease = 0, None, 0
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def acquire(self, wait=True):
+        with self.condition:
+            if wait:
+                self.condition.wait_for(lambda: self.running < self.concurrency)
+            self.running += 1
+        return monotonic()
+
+    def is_congested(self, result, duration):
+        latency_threshold = self.latency_factor * (self.average_duration or inf)
+        if duration > latency_threshold:
+            return True
+        if not result or result.get("success"):
+            return False
+        error = str(result.get("result", "")).lower()
+        return any(pattern in error for pattern in self.congestion_errors)
+
+    def release(self, start, result):
+        duration = monotonic() - start
+        with self.condition:
+            self.running -= 1
+            concurrency = self.concurrency
+            if self.is_congested(result, duration):
+                if start > self.last_decrease:
+                    self.limit = max(1.0, self.limit * self.backoff_factor)
+                    self.last_decrease = monotonic()
+            elif result and result.get("success"):
+                self.limit = min(self.maximum, self.limit + 1 / concurrency)
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+            new_concurrency = self.concurrency
+            self.condition.notify_all()
+        if new_concurrency != concurrency and self.callback:
+            self.callback(new_concurrency)
+
 
 class RunEngine:
     def __init__(self, run, **kwargs):
@@ -70,6 +141,8 @@ class RunEngine:
         self.runtime = self.parent_runtime if self.is_main_run else vs.get_time()
         self.has_result = False
         self.run_targets = []
+        self.global_builtins = self.global_variables_base = None
+        self.iteration_overrides = local()
         vs.run_instances[self.runtime] = self
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -79,8 +152,14 @@ class RunEngine:
         self.dry_run = getattr(run, "dry_run", False) or self.get("dry_run")
         device_progress = "iteration_device" if self.iteration_run else "device"
         self.progress_key = f"progress/{device_progress}"
-        self.cache = {**run.cache, "service": self.get_service_properties()}
-        self.main_run = run if self.is_main_run else run.main_run
+        self.cache = ChainMap(
+            {"service": self.get_service_properties()},
+            vs.run_contexts[self.parent_runtime],
+        )
+        if self.is_main_run:
+            self.main_run = run
+        elif "main_run" not in kwargs:
+            self.main_run = run.main_run
         self.high_performance = self.cache["main_run_service"]["high_performance"]
         if env.redis_queue:
             env.redis("sadd", f"{self.parent_runtime}/services", self.service.id)
@@ -96,6 +175,10 @@ class RunEngine:
     def __getattr__(self, key):
         if key in self.__dict__:
             return self.__dict__[key]
+        elif key == "connection_name" and hasattr(
+            self.__dict__.get("iteration_overrides"), key
+        ):
+            return self.iteration_overrides.connection_name
         elif set(self.__dict__) & {"service_id", "service"}:
             return getattr(self.service, key)
         else:
@@ -104,6 +187,14 @@ class RunEngine:
     def __repr__(self):
         return f"{self.runtime}: SERVICE '{self.service}'"
 
+    def advance_steps(self, steps, response=None, exception=None):
+        with db.session_scope(commit=True, remove=True):
+            try:
+                step = steps.throw(exception) if exception else steps.send(response)
+            except StopIteration as stop:
+                return True, stop.value
+            return False, step
+
     def build_notification(self, results):
         notification = {
             "Service": f"{self.service.name} ({self.service.type})",
@@ -128,16 +219,19 @@ class RunEngine:
     def compute_targets_and_collect_results(self):
         if not self.run_targets:
             self.run_targets = self.compute_run_targets()
-        allowed_devices, restricted_devices = [], []
+        allowed_devices, restricted_devices, uncached_ids = [], [], []
         device_cache = self.cache["topology"]["name_to_dict"]["devices"]
         for device in self.run_targets:
             if device.id in vs.run_allowed_targets[self.parent_runtime]:
                 allowed_devices.append(device)
                 if self.high_performance and device.name not in device_cache:
-                    device_namespace = SimpleNamespace(**device.get_properties())
-                    device_cache[device.name] = device_namespace
+                    uncached_ids.append(device.id)
             else:
                 restricted_devices.append(device.name)
+        if uncached_ids:
+            with db.session_scope(remove=self.in_process):
+                for record in db.fetch_records("device", uncached_ids):
+                    device_cache[record.name] = record
         if restricted_devices:
             result = (
                 f"Error 403: User '{self.creator}' is not allowed to use these"
@@ -153,9 +247,25 @@ class RunEngine:
             self.write_state(
                 "progress/device/total", len(self.run_targets), "increment"
             )
-            for device in self.run_targets:
-                key = "success" if self.device_iteration(device) else "failure"
-                self.write_state(f"progress/device/{key}", 1, "increment")
+            concurrency = self.get_iteration_concurrency(len(self.run_targets))
+            if concurrency > 1:
+                parent_ids = {
+                    "service": self.service.id,
+                    "workflow": self.workflow.id,
+                    "main_run": self.main_run.id,
+                }
+                iterations = env.job_executor.map(
+                    self.creator,
+                    self.parent_runtime,
+                    f"{self.runtime} (device iterations)",
+                    self.device_iteration_in_thread,
+                    [(device, parent_ids) for device in self.run_targets],
+                    quota=concurrency,
+                )
+            else:
+                iterations = map(self.device_iteration, self.run_targets)
+            for device, success in zip(self.run_targets, iterations):
+                key = "success" if success else "failure"
                 summary[key].append(device.name)
             return {
                 "success": not summary["failure"],
@@ -230,25 +340,58 @@ class RunEngine:
                 )
                 self.log("error", error)
                 return {"success": False, "runtime": self.runtime, "result": error}
-            if (
+            fan_out = (
                 self.get("multiprocessing")
                 and len(non_skipped_targets) > 1
                 and not self.in_process
                 and not self.iteration_run
+            )
+            mode = self.get("multiprocessing_mode")
+            device_credentials = getattr(self.service, "credentials", None)
+            if fan_out and device_credentials in ("device", "custom"):
+                self.resolve_credentials(non_skipped_targets)
+            if fan_out and mode == "process" and not self.high_performance:
+                self.log("warning", "Process mode requires high performance mode")
+            local_leases = env.device_leases.active and not env.redis_queue
+            if fan_out and mode == "process" and local_leases:
+                log = "Process mode requires Redis when device leases are active"
+                self.log("warning", log)
+            if fan_out and mode == "asyncio":
+                coroutines = min(len(non_skipped_targets), self.get("max_processes"))
+                self.log("info", f"Starting an event loop with {coroutines} coroutines")
+                results.extend(asyncio_run(self.run_in_event_loop(non_skipped_targets)))
+            elif (
+                fan_out
+                and mode == "process"
+                and self.high_performance
+                and not local_leases
             ):
+                results.extend(self.run_in_process_pool(non_skipped_targets))
+            elif fan_out:
                 processes = min(len(non_skipped_targets), self.get("max_processes"))
-                refetch_ids = {
-                    key: value.id
-                    for key, value in self.kwargs.items()
-                    if hasattr(value, "id")
-                }
+                refetch_ids = self.get_refetch_ids()
                 process_args = [
                     (device.id, self.runtime, results, refetch_ids)
                     for device in non_skipped_targets
                 ]
-                self.log("info", f"Starting a pool of {processes} threads")
-                with ThreadPool(processes=processes) as pool:
-                    pool.map(self.get_device_result_in_process, process_args)
+                function, quota = self.get_device_result_in_process, processes
+                if self.get("adaptive_concurrency"):
+                    function = self.run_with_adaptive_concurrency(function, processes)
+                    quota = None
+                if env.job_executor.active:
+                    self.log("info", f"Sending jobs to the executor ({processes} max)")
+                    env.job_executor.map(
+                        self.creator,
+                        self.parent_runtime,
+                        self.runtime,
+                        function,
+                        process_args,
+                        quota=quota,
+                    )
+                else:
+                    self.log("info", f"Starting a pool of {processes} threads")
+                    with ThreadPool(processes=processes) as pool:
+                        pool.map(function, process_args)
             else:
                 results.extend(
                     [
@@ -266,9 +409,10 @@ class RunEngine:
                 "runtime": self.runtime,
             }
 
-    def check_size(self, data, data_type):
+    def check_size(self, data, data_type, data_size=None):
         column_type = "pickletype" if data_type == "result" else "large_string"
-        data_size = getsizeof(str(data))
+        if data_size is None:
+            data_size = getsizeof(data if isinstance(data, str) else str(data))
         self.write_state("memory_size", data_size, "increment", top_level=True)
         if data_type == "result":
             data["memory_size"] = data_size
@@ -296,11 +440,19 @@ class RunEngine:
     def create_transient_report(self, report):
         vs.service_report[self.parent_runtime][self.service.id] = report
 
-    def create_transient_result(self, result, device):
+    def create_transient_result(self, result, device, data):
         device_key = device.id if device else None
         if env.redis_queue:
-            path = f"{self.parent_runtime}/results/{self.service.id}/{device_key}"
-            env.redis("lpush", path, or_dumps(result))
+            index = f"{self.parent_runtime}/results/{self.service.id}"
+            path = f"{index}/{device_key}"
+            properties = {
+                key: value for key, value in result.items() if key != "result"
+            }
+            data = b'%s,"result":%s}' % (or_dumps(properties)[:-1], data)
+            pipeline = env.redis("pipeline", transaction=False)
+            pipeline.lpush(path, data).sadd(f"{self.parent_runtime}/results", path)
+            pipeline.sadd(index, path).sadd(f"{self.parent_runtime}/keys", index)
+            pipeline.execute()
         else:
             vs.service_result[self.parent_runtime][self.service.id][device_key].append(
                 result
@@ -328,6 +480,9 @@ class RunEngine:
         if self.is_main_run and not device:
             results["payload"] = self.payload
             if self.main_run.trigger == "REST API" and not self.high_performance:
+                if env.result_writer.active:
+                    env.result_writer.flush()
+                    db.session.expire(self.main_run, ["results"])
                 results["devices"] = {}
                 for result in self.main_run.results:
                     if not result.device:
@@ -336,13 +491,14 @@ class RunEngine:
         else:
             results.pop("payload", None)
         create_failed_results = self.disable_result_creation and not self.success
-        results = self.make_json_compliant(results)
-        results = self.check_size(results, "result")
+        results, data = self.serialize(results)
+        results = self.check_size(results, "result", len(data))
+        data = b'%s,"memory_size":%d}' % (data[:-1], results["memory_size"])
         result_kw["memory_size"] = results["memory_size"]
         result_kw["result"] = results
         if not self.disable_result_creation or create_failed_results or run_result:
             self.has_result = True
-            if not self.high_performance:
+            if not self.high_performance and not env.result_writer.active:
                 try:
                     db.factory(
                         "result",
@@ -357,39 +513,23 @@ class RunEngine:
                 for key in ("duration", "runtime", "success"):
                     result_kw[key] = results[key]
                 result_kw["name"] = f"{results['runtime']} - {vs.get_persistent_id()}"
-                self.create_transient_result(result_kw, device)
+                if env.result_writer.active:
+                    env.result_writer.add(result_kw)
+                else:
+                    self.create_transient_result(result_kw, device, data)
         return results
 
     def compute_devices_from_query(_self, query, property, **locals):  # noqa: N805
         values = _self.eval(query, **locals)[0]
-        devices, not_found = set(), []
         if isinstance(values, str):
             values = [values]
         if all(isinstance(value, vs.models["device"]) for value in values):
             return set(values)
-        elif _self.high_performance:
-            with db.session_scope(remove=_self.in_process):
-                devices = (
-                    db.query("device", user=_self.creator)
-                    .options(selectinload(vs.models["device"].gateways))
-                    .filter(getattr(vs.models["device"], property).in_(values))
-                    .all()
-                )
-            if len(devices) != len(values):
-                found = {getattr(device, property) for device in devices}
-                not_found = set(values) - found
-        else:
-            for value in values:
-                device = db.fetch(
-                    "device",
-                    allow_none=True,
-                    user=_self.creator,
-                    **{property: str(value)},
-                )
-                if device:
-                    devices.add(device)
-                else:
-                    not_found.append(str(value))
+        values = {str(value) for value in values}
+        with db.session_scope(remove=_self.high_performance and _self.in_process):
+            devices = _self.fetch_devices(values, property)
+        found = {str(getattr(device, property)) for device in devices}
+        not_found = sorted(values - found)
         if not_found:
             raise Exception(f"Device query invalid targets: {', '.join(not_found)}")
         return devices
@@ -402,18 +542,20 @@ class RunEngine:
                 self.get_target_property("device_query"),
                 self.get_target_property("device_query_property"),
             )
+        if not self.high_performance and self.is_main_run:
+            self.main_run.target_devices = list(devices)
+            self.main_run.target_pools = list(pools)
+        if not pools:
+            return devices
         if not self.high_performance:
-            if self.is_main_run:
-                self.main_run.target_devices = list(devices)
-                self.main_run.target_pools = list(pools)
-            for pool in pools:
-                if self.update_target_pools:
+            if self.update_target_pools:
+                for pool in pools:
                     pool.compute_pool()
-                devices |= set(pool.devices)
-                db.session.commit()
-        else:
-            devices |= set().union(*(pool.devices for pool in pools))
-        return devices
+            db.session.commit()
+        with db.session_scope(remove=self.high_performance and self.in_process):
+            pool_device_ids = db.get_pool_device_ids(pool.id for pool in pools)
+            device_ids = pool_device_ids - {device.id for device in devices}
+            return devices | self.fetch_devices(device_ids)
 
     def convert_result(self, result):
         if self.conversion_method == "none" or "result" not in result:
@@ -434,29 +576,61 @@ class RunEngine:
             }
         return result
 
-    def device_iteration(self, device):
+    def device_iteration(self, device, parent_ids=None):
+        service, workflow, main_run = self.service, self.workflow, self.main_run
+        if parent_ids and not self.high_performance:
+            service = db.fetch("service", id=parent_ids["service"], rbac=None)
+            workflow = db.fetch("workflow", id=parent_ids["workflow"], rbac=None)
+            main_run = db.fetch("run", id=parent_ids["main_run"], rbac=None)
         derived_devices = self.compute_devices_from_query(
-            self.service.iteration_devices,
-            self.service.iteration_devices_property,
-            **locals(),
+            service.iteration_devices,
+            service.iteration_devices_property,
+            self=self,
+            device=device,
         )
         service_run = Runner(
             self.run,
             iteration_run=True,
             payload=self.payload,
-            service=self.service,
+            service=service,
             run_targets=derived_devices,
-            workflow=self.workflow,
+            workflow=workflow,
+            main_run=main_run,
             parent_device=device,
             parent=self,
             parent_runtime=self.parent_runtime,
         )
-        return service_run.start_run()["success"]
+        success = service_run.start_run()["success"]
+        key = "success" if success else "failure"
+        self.write_state(f"progress/device/{key}", 1, "increment")
+        return success
+
+    def device_iteration_in_thread(self, args):
+        device, parent_ids = args
+        with db.session_scope(commit=True, remove=True):
+            if not self.high_performance:
+                device = db.fetch("device", id=device.id, rbac=None)
+            return self.device_iteration(device, parent_ids)
 
     def eval(_self, query, function="eval", **locals):  # noqa: N805
         exec_variables = _self.global_variables(**locals)
+        results = _self.execute(query, None, exec_variables, function) if query else ""
+        return results, exec_variables
+
+    def fetch_devices(self, values, property="id"):
+        column, devices = getattr(vs.models["device"], property), set()
+        query = db.query("device", user=self.creator)
+        if self.high_performance:
+            query = query.options(selectinload(vs.models["device"].gateways))
+        for batch in batched(values, vs.database["transactions"]["batch_size"]):
+            devices.update(query.filter(column.in_(batch)).all())
+        return devices
+
+    def execute(self, query, code, variables, function="eval"):
         try:
-            results = builtins[function](query, exec_variables) if query else ""
+            if code is None:
+                code = env.code_cache.compile(query, function, self.service)
+            return builtins[function](code, variables)
         except Exception as exc:
             exc.args = (
                 (
@@ -465,7 +639,6 @@ class RunEngine:
                 ),
             )
             raise
-        return results, exec_variables
 
     def generate_report(self, results):
         try:
@@ -474,10 +647,11 @@ class RunEngine:
                 variables = {
                     "service": self.service,
                     "results": results,
-                    **self.global_variables(),
+                    **self.template_variables(),
                 }
                 if self.service.report_jinja2_template:
-                    report = Template(self.service.report).render(variables)
+                    template = env.get_jinja2_template(self.service.report)
+                    report = template.render(variables)
                 else:
                     report = self.sub(self.service.report, variables)
         except Exception:
@@ -504,24 +678,38 @@ class RunEngine:
         else:
             return getattr(self, property)
 
+    @staticmethod
+    def get_device_result_in_subprocess(args):
+        runtime, device = args
+        run = vs.run_instances[runtime]
+        try:
+            results = run.run_job_and_collect_results(device, commit=False)
+        finally:
+            run.close_device_connection(device.name)
+        service_results = vs.service_result.pop(run.parent_runtime, {})
+        run_data = {
+            "changelogs": vs.service_changelog.pop(run.parent_runtime, []),
+            "logs": dict(vs.run_logs.pop(run.parent_runtime, {})),
+            "results": {
+                service_id: dict(device_results)
+                for service_id, device_results in service_results.items()
+            },
+            "services": vs.run_services.pop(run.parent_runtime, set()),
+            "state": vs.subprocess_state[:],
+        }
+        vs.subprocess_state.clear()
+        env.result_writer.flush()
+        if env.redis_queue:
+            env.run_log_buffer.flush()
+            env.run_state_store.flush()
+        return run.make_json_compliant(results), run_data
+
     @staticmethod
     def get_device_result_in_process(args):
         device_id, runtime, results, refetch_ids = args
         run = vs.run_instances[runtime]
         if not run.high_performance:
             device = db.fetch("device", id=device_id, rbac=None)
-            run_kwargs = {"in_process": True}
-            for key, value in run.kwargs.items():
-                try:
-                    run_kwargs[key] = db.fetch(
-                        value.type, id=refetch_ids[key], rbac=None
-                    )
-                except Exception as exc:
-                    if isinstance(exc, SQLAlchemyError):
-                        db.session.rollback()
-                    run_kwargs[key] = value
-            if isinstance(run, vs.models["run"]):
-                run = db.fetch("run", runtime=run.runtime, rbac=None)
         else:
             with db.session_scope(remove=True):
                 device = (
@@ -530,8 +718,54 @@ class RunEngine:
                     .filter(vs.models["device"].id == device_id)
                     .one()
                 )
-            run_kwargs = {"in_process": True, **run.kwargs}
-        results.append(Runner(run, **run_kwargs).run_job_and_collect_results(device))
+        runner = run.get_in_process_runner(refetch_ids)
+        result = runner.run_job_and_collect_results(device)
+        results.append(result)
+        return result
+
+    def get_in_process_runner(self, refetch_ids):
+        run, run_kwargs = self, {"in_process": True}
+        if self.high_performance:
+            return Runner(run, **{**run_kwargs, **self.kwargs})
+        for key, value in self.kwargs.items():
+            try:
+                run_kwargs[key] = db.fetch(value.type, id=refetch_ids[key], rbac=None)
+            except Exception as exc:
+                if isinstance(exc, SQLAlchemyError):
+                    db.session.rollback()
+                run_kwargs[key] = value
+        return Runner(run, **run_kwargs)
+
+    def get_refetch_ids(self):
+        return {
+            key: value.id for key, value in self.kwargs.items() if hasattr(value, "id")
+        }
+
+    def get_device_snapshot(self, device):
+        if isinstance(device, Record):
+            return device
+        gateways = [db.get_record(gateway) for gateway in device.gateways]
+        return db.get_record(device, gateways=gateways)
+
+    def get_template_segments(self, input):
+        templates = vs.run_templates[self.parent_runtime]
+        if input not in templates:
+            segments = []
+            for index, part in enumerate(SUBSTITUTION_REGEX.split(input)):
+                if index % 2 == 0:
+                    segments.append(part)
+                    continue
+                try:
+                    code = env.code_cache.compile(part.lstrip(" \t"), "eval")
+                except SyntaxError:
+                    code = part
+                segments.append((part, code))
+            templates[input] = segments
+        return templates[input]
+
+    def get_iteration_concurrency(self, iterations):
+        concurrency = self.get("iteration_max_concurrency") or 1
+        return min(concurrency, iterations, vs.settings["automation"]["max_process"])
 
     def get_service_properties(self):
         return {
@@ -582,6 +816,21 @@ class RunEngine:
                 self.write_state(f"placeholder/{property}", value)
         self.write_state("success", True)
 
+    @staticmethod
+    def initialize_subprocess(runtime):
+        db.session.registry.clear()
+        db.engine.dispose(close=False)
+        run = vs.run_instances[runtime]
+        run.in_process = True
+        vs.subprocess_state = []
+        env.init_run_helpers()
+        for store in (vs.run_logs, vs.service_changelog, vs.run_services):
+            store.pop(run.parent_runtime, None)
+        vs.service_result.pop(run.parent_runtime, None)
+        vs.connections_cache = {
+            library: defaultdict(dict) for library in vs.connections_cache
+        }
+
     def log(
         self,
         severity,
@@ -629,25 +878,20 @@ class RunEngine:
                 )
 
     def make_json_compliant(self, input):
-        def rec(value):
-            if isinstance(value, dict):
-                return {rec(key): rec(value[key]) for key in list(value)}
-            elif isinstance(value, list):
-                return list(map(rec, value))
-            elif not isinstance(
-                value, (int, str, bool, float, None.__class__)
-            ) or value in (float("inf"), float("-inf")):
-                self.log("info", f"Converting {value} to string")
-                return str(value)
-            else:
-                return value
+        return self.serialize(input)[0]
+
+    def serialize(self, input):
+        def convert(value):
+            self.log("info", f"Converting {value} to string")
+            return str(value)
 
         try:
-            return rec(input)
+            return encode_json(input, convert)
         except Exception:
             log = f"Payload conversion to JSON failed:\n{format_exc()}"
             self.log("error", log)
-            return {"error": log}
+            result = {"error": log}
+            return result, dumps(result).encode("utf-8")
 
     def match_dictionary(self, result, match, first=True):
         if self.validation_method == "dict_equal":
@@ -676,6 +920,7 @@ class RunEngine:
         notification = self.build_notification(results)
         file_content = deepcopy(notification)
         if self.include_device_results and not self.high_performance:
+            env.result_writer.flush()
             file_content["Device Results"] = {}
             for device in self.run_targets:
                 device_result = db.fetch(
@@ -722,7 +967,73 @@ class RunEngine:
         results["notification"] = {"success": True, "result": result}
         return results
 
+    def run_job(self, device):
+        args = (device,) if device else ()
+        return vs.models[self.service.type].job(self.service, self, *args)
+
+    async def run_job_async(self, device, executor):
+        model = vs.models[self.service.type]
+        if hasattr(model, "async_job"):
+            return await model.async_job(self.service, self, device)
+        return await get_running_loop().run_in_executor(
+            executor, self.run_job_in_thread, device
+        )
+
+    def run_iterations(self, device, targets, concurrency):
+        connection_name = getattr(self.service, "connection_name", "default")
+        if device and env.device_leases.active:
+            session_limit = env.device_leases.get_limit(device)
+            concurrency = min(concurrency, session_limit or concurrency)
+        slots = SimpleQueue()
+        for slot in range(concurrency):
+            slots.put(slot)
+
+        def run_iteration(value):
+            overrides, slot = self.iteration_overrides, slots.get()
+            with db.session_scope(commit=True, remove=True):
+                overrides.variables = {self.iteration_variable_name: value}
+                overrides.connection_name = f"{connection_name} (iteration slot {slot})"
+                if slot:
+                    lease_owner = f"{self.parent_runtime} (iteration slot {slot})"
+                    overrides.lease_owner = lease_owner
+                try:
+                    iteration_device = device
+                    if device and not self.high_performance:
+                        iteration_device = db.fetch("device", id=device.id, rbac=None)
+                    return self.run_steps(self.service_job_steps(iteration_device))
+                finally:
+                    del overrides.variables, overrides.connection_name
+                    overrides.__dict__.pop("lease_owner", None)
+                    slots.put(slot)
+
+        target = f"{device.name} iterations" if device else "iterations"
+        try:
+            results = env.job_executor.map(
+                self.creator,
+                self.parent_runtime,
+                f"{self.runtime} ({target})",
+                run_iteration,
+                targets.values(),
+                quota=concurrency,
+            )
+        finally:
+            for slot in range(concurrency if device else 0):
+                name = f"{connection_name} (iteration slot {slot})"
+                self.close_device_connection(device.name, release=True, name=name)
+        return dict(zip(targets, results))
+
+    def run_job_in_thread(self, device):
+        with db.session_scope(commit=True, remove=True):
+            if self.high_performance:
+                return self.run_job(device)
+            device = db.fetch("device", id=device.id, rbac=None)
+            runner = self.get_in_process_runner(self.get_refetch_ids())
+            return runner.run_job(device)
+
     def run_job_and_collect_results(self, device=None, commit=True):
+        return self.run_steps(self.job_and_collect_results_steps(device, commit))
+
+    def job_and_collect_results_steps(self, device=None, commit=True):
         self.log("info", "STARTING", device)
         start = datetime.now().replace(microsecond=0)
         results = {"device_target": getattr(device, "name", None)}
@@ -736,13 +1047,20 @@ class RunEngine:
                     if isinstance(targets, (GeneratorType, map, filter)):
                         targets = list(targets)
                     targets = dict(zip(map(str, targets), targets))
+                concurrency = self.get_iteration_concurrency(len(targets))
+                if concurrency > 1:
+                    targets_results = yield "iterations", (device, targets, concurrency)
                 for target_name, target_value in targets.items():
                     self.payload_helper(
                         self.iteration_variable_name,
                         target_value,
                         device=getattr(device, "name", None),
                     )
-                    targets_results[target_name] = self.run_service_job(device)
+                    if concurrency > 1:
+                        continue
+                    targets_results[target_name] = yield from self.service_job_steps(
+                        device
+                    )
                 results.update(
                     {
                         "result": targets_results,
@@ -752,15 +1070,17 @@ class RunEngine:
                     }
                 )
             else:
-                results.update(self.run_service_job(device))
+                results.update((yield from self.service_job_steps(device)))
         except Exception:
             formatted_error = "\n".join(format_exc().splitlines())
             results.update({"success": False, "result": formatted_error})
             self.log("error", formatted_error, device)
         results["duration"] = str(datetime.now().replace(microsecond=0) - start)
         if device:
-            if getattr(self, "close_connection", False) or self.is_main_run:
+            if getattr(self, "close_connection", False):
                 self.close_device_connection(device.name)
+            elif self.is_main_run:
+                self.close_device_connection(device.name, release=True)
             status = "success" if results["success"] else "failure"
             self.write_state(f"{self.progress_key}/{status}", 1, "increment")
             self.create_result(
@@ -769,13 +1089,54 @@ class RunEngine:
         self.log("info", "FINISHED", device)
         if self.waiting_time:
             self.log("info", f"SLEEP {self.waiting_time} seconds...", device)
-            sleep(self.waiting_time)
+            yield "sleep", self.waiting_time
         if not results["success"]:
             self.write_state("success", False)
         return results
 
     def run_service_job(self, device):
-        args = (device,) if device else ()
+        return self.run_steps(self.service_job_steps(device))
+
+    def run_steps(self, steps):
+        response, exception = None, None
+        while True:
+            try:
+                step = steps.throw(exception) if exception else steps.send(response)
+            except StopIteration as stop:
+                return stop.value
+            response, exception = None, None
+            try:
+                if step[0] == "sleep":
+                    sleep(step[1])
+                elif step[0] == "iterations":
+                    response = self.run_iterations(*step[1])
+                else:
+                    response = self.run_job(step[1])
+            except Exception as exc:
+                exception = exc
+
+    async def run_steps_async(self, steps, executor):
+        loop, response, exception = get_running_loop(), None, None
+        while True:
+            done, step = await loop.run_in_executor(
+                executor, self.advance_steps, steps, response, exception
+            )
+            if done:
+                return step
+            response, exception = None, None
+            try:
+                if step[0] == "sleep":
+                    await async_sleep(step[1])
+                elif step[0] == "iterations":
+                    response = await get_running_loop().run_in_executor(
+                        executor, self.run_iterations, *step[1]
+                    )
+                else:
+                    response = await self.run_job_async(step[1], executor)
+            except Exception as exc:
+                exception = exc
+
+    def service_job_steps(self, device):
         retries, total_retries = self.number_of_retries + 1, 0
         results = {}
         while retries and total_retries < self.max_number_of_retries:
@@ -796,8 +1157,7 @@ class RunEngine:
                     except SystemExit:
                         pass
                 try:
-                    model = vs.models[self.service.type]
-                    results = model.job(self.service, self, *args)
+                    results = yield "job", device
                 except Exception:
                     result = "\n".join(format_exc().splitlines())
                     self.log("error", result, device)
@@ -846,13 +1206,74 @@ class RunEngine:
                 if results["success"]:
                     return results
                 elif retries:
-                    sleep(self.time_between_retries)
+                    yield "sleep", self.time_between_retries
             except Exception:
                 result = "\n".join(format_exc().splitlines())
                 self.log("error", result, device)
                 results = {"result": result, "result_dict": results, "success": False}
         return results
 
+    async def run_in_event_loop(self, devices):
+        semaphore = Semaphore(self.get("max_processes"))
+        threads = min(
+            self.get("max_processes"), vs.settings["automation"]["max_process"]
+        )
+        self.async_connections = {}
+
+        async def get_device_result(device):
+            async with semaphore:
+                steps = self.job_and_collect_results_steps(device, commit=False)
+                try:
+                    return await self.run_steps_async(steps, executor)
+                finally:
+                    await self.close_async_connection(device)
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            return await gather(*(get_device_result(device) for device in devices))
+
+    def run_in_process_pool(self, devices):
+        processes = min(len(devices), self.get("max_processes"))
+        self.log("info", f"Starting a pool of {processes} processes")
+        process_args = [
+            (self.runtime, self.get_device_snapshot(device)) for device in devices
+        ]
+        results = []
+        with get_context("fork").Pool(
+            processes=processes,
+            initializer=self.initialize_subprocess,
+            initargs=(self.runtime,),
+        ) as pool:
+            for result, run_data in pool.imap_unordered(
+                RunEngine.get_device_result_in_subprocess, process_args
+            ):
+                self.update_run_data(run_data)
+                results.append(result)
+        return results
+
+    def run_with_adaptive_concurrency(self, function, maximum):
+        executor = env.job_executor.active
+
+        def update_concurrency(concurrency):
+            if executor:
+                env.job_executor.set_quota(self.runtime, concurrency)
+            self.log("info", f"Concurrency set to {concurrency}")
+            self.write_state("concurrency/current", concurrency)
+            history_entry = f"{vs.get_time()}: {concurrency}"
+            self.write_state("concurrency/history", history_entry, "append")
+
+        controller = AdaptiveConcurrency(maximum, update_concurrency)
+        update_concurrency(controller.concurrency)
+
+        def run_function(args):
+            start, result = controller.acquire(wait=not executor), None
+            try:
+                result = function(args)
+                return result
+            finally:
+                controller.release(start, result)
+
+        return run_function
+
     def safe_log(self, original, modified):
         if "get_secret" in original or "get_credential" in original:
             return original
@@ -892,12 +1313,16 @@ class RunEngine:
             results["duration"] = str(now - start)
             self.write_state("success", results["success"])
             if self.is_main_run:
-                if isinstance(self.service, SimpleNamespace):
-                    properties = vars(self.service)
-                    properties.update({"target_devices": None, "target_pools": None})
+                if isinstance(self.service, Record):
+                    properties = {
+                        **self.service.get_properties(),
+                        "target_devices": None,
+                        "target_pools": None,
+                    }
                 else:
                     properties = self.service.get_properties(exclude=["positions"])
                 results["properties"] = properties
+                self.log("debug", f"Code cache statistics: {env.code_cache.statistics}")
             must_have_results = not self.has_result and not self.iteration_devices
             if self.is_main_run or len(self.run_targets) > 1 or must_have_results:
                 results = self.create_result(results, run_result=self.is_main_run)
@@ -913,15 +1338,19 @@ class RunEngine:
             return vs.run_stop[self.parent_runtime]
 
     def sub(self, input, variables):
-        regex = compile("{{(.*?)}}")
         variables["payload"] = self.payload
+        namespace = {}
 
-        def replace(match):
-            return str(self.eval(match.group()[2:-2], **variables)[0])
+        def replace(segment):
+            if isinstance(segment, str):
+                return segment
+            if not namespace:
+                namespace.update(self.global_variables(**variables))
+            return str(self.execute(*segment, namespace))
 
         def rec(input):
             if isinstance(input, str):
-                return regex.sub(replace, input)
+                return "".join(map(replace, self.get_template_segments(input)))
             elif isinstance(input, list):
                 return [rec(item) for item in input]
             elif isinstance(input, dict):
@@ -931,6 +1360,22 @@ class RunEngine:
 
         return rec(input)
 
+    def update_run_data(self, run_data):
+        for service_id, logs in run_data["logs"].items():
+            if logs is None:
+                vs.run_logs[self.parent_runtime][service_id] = None
+            else:
+                vs.run_logs[self.parent_runtime][service_id].extend(logs)
+        for service_id, device_results in run_data["results"].items():
+            for device_key, results in device_results.items():
+                vs.service_result[self.parent_runtime][service_id][device_key].extend(
+                    results
+                )
+        vs.service_changelog[self.parent_runtime].extend(run_data["changelogs"])
+        vs.run_services[self.parent_runtime] |= run_data["services"]
+        for state_operation in run_data["state"]:
+            env.run_state_store.update_local_state(*state_operation)
+
     def validate_result(self, section, device):
         if self.validation_method == "text":
             match = self.sub(self.content_match, locals())
@@ -950,37 +1395,87 @@ class RunEngine:
         return {"success": success, "validation": validation}
 
     def write_state(self, path, value, method=None, top_level=False):
-        parent_path = "" if top_level else f"/{self.path}"
+        field = path if top_level else f"{self.path}/{path}"
         if env.redis_queue:
             if isinstance(value, bool):
                 value = str(value)
-            env.redis(
-                {
-                    None: "set",
-                    "append": "lpush",
-                    "increment": "incr",
-                    "delete": "delete",
-                }[method],
-                f"{self.parent_runtime}/state{parent_path}/{path}",
-                value,
-            )
+            env.run_state_store.write(self.parent_runtime, field, value, method)
+        elif vs.subprocess_state is not None:
+            key = f"{self.parent_runtime}/{field}"
+            vs.subprocess_state.append((key, value, method))
         else:
-            *keys, last = f"{self.parent_runtime}{parent_path}/{path}".split("/")
-            store = vs.run_states
-            for key in keys:
-                store = store.setdefault(key, {})
-            if not method:
-                store[last] = value
-            elif method == "increment":
-                store.setdefault(last, 0)
-                store[last] += value
-            elif method == "delete":
-                store.pop(last, None)
-            else:
-                store.setdefault(last, []).append(value)
+            env.run_state_store.write(self.parent_runtime, field, value, method)
 
 
 class NetworkManagement:
+    def acquire_device_lease(self, device):
+        limit = env.device_leases.get_limit(device)
+        if env.device_leases.active and limit:
+            self.log("info", f"Acquiring a session slot ({limit} max)", device)
+        owner = getattr(self.iteration_overrides, "lease_owner", self.parent_runtime)
+        try:
+            lease = env.device_leases.acquire(device, owner)
+            return env.job_executor.acquire_connection(lease)
+        except Exception as exc:
+            self.log("error", str(exc), device)
+            raise
+
+    async def async_scrapli_connection(self, device):
+        connection = self.async_connections.get(device.name)
+        connection_name = f"Async Scrapli Connection '{self.connection_name}'"
+        if connection:
+            self.log("info", f"Using cached {connection_name}", device)
+            return connection
+        self.log(
+            "info",
+            f"OPENING {connection_name}",
+            device,
+            change_log=False,
+            logger="security",
+        )
+        credentials = self.get_credentials(device)
+        platform = device.scrapli_driver if self.driver == "device" else self.driver
+        if self.transport != "asyncssh":
+            log = f"Using the asyncssh transport instead of '{self.transport}'"
+            self.log("info", f"{log} (asyncio mode)", device)
+        lease = await get_running_loop().run_in_executor(
+            None, self.acquire_device_lease, device
+        )
+        with self.release_lease_on_failure(lease):
+            connection = AsyncScrapli(
+                host=device.ip_address,
+                auth_username=credentials["username"],
+                auth_password=credentials["password"],
+                **{
+                    **vs.automation["scrapli"]["connection_args"],
+                    "transport": "asyncssh",
+                },
+                platform=platform,
+                timeout_socket=self.timeout_socket,
+                timeout_transport=self.timeout_transport,
+                timeout_ops=self.timeout_ops,
+            )
+            await connection.open()
+        connection.connection_name = self.connection_name
+        connection.device_lease = lease
+        self.write_state("connections/scrapli", 1, "increment", True)
+        self.async_connections[device.name] = connection
+        return connection
+
+    def borrow_connection(self, device, pool_key):
+        if self.start_new_connection:
+            return
+        connection = env.connection_pool.borrow(pool_key)
+        if not connection:
+            return
+        try:
+            lease = self.acquire_device_lease(device)
+        except Exception:
+            env.connection_pool.release(connection)
+            raise
+        self.log("info", f"Using pooled {pool_key[0]} connection", device)
+        return self.store_connection(device, connection, pool_key, lease)
+
     def check_connection_numbers(self):
         if not vs.automation["connections"]["enforce_threshold"]:
             return
@@ -994,10 +1489,27 @@ class NetworkManagement:
             if vs.automation["connections"]["raise_exception"]:
                 raise OverflowError(log)
 
-    def close_device_connection(self, device):
+    async def close_async_connection(self, device):
+        connection = self.async_connections.pop(getattr(device, "name", None), None)
+        if not connection:
+            return
+        connection_log = f"async scrapli connection '{connection.connection_name}'"
+        try:
+            await connection.close()
+            self.write_state("connections/scrapli", -1, "increment", True)
+            self.log("info", f"Closed {connection_log}", device)
+        except Exception:
+            self.log("error", f"Error closing {connection_log}\n{format_exc()}", device)
+        finally:
+            if connection.device_lease:
+                connection.device_lease.release()
+
+    def close_device_connection(self, device, release=False, name=None):
         for library in ("netmiko", "napalm", "scrapli", "ncclient"):
-            connection = self.get_connection(library, device)
-            if connection:
+            connection = self.get_connection(library, device, name)
+            if connection and release:
+                self.release_connection(library, device, connection)
+            elif connection:
                 self.disconnect(library, device, connection)
 
     def configuration_transaction(self, property, device, **kwargs):
@@ -1030,18 +1542,8 @@ class NetworkManagement:
     def disconnect(self, library, device, connection):
         connection_log = f"{library} connection '{connection.connection_name}'"
         try:
-            if library == "netmiko":
-                connection.disconnect()
-            elif library == "ncclient":
-                connection.close_session()
-            else:
-                connection.close()
-            vs.connections_cache[library][self.parent_runtime][device].pop(
-                connection.connection_name
-            )
-            if not vs.connections_cache[library][self.parent_runtime][device]:
-                vs.connections_cache[library][self.parent_runtime].pop(device)
-            self.write_state(f"connections/{library}", -1, "increment", True)
+            env.connection_pool.close_connection(library, connection)
+            self.remove_connection(library, device, connection)
             self.log("info", f"Closed {connection_log}", device)
         except Exception:
             self.log("error", f"Error closing {connection_log}\n{format_exc()}", device)
@@ -1095,47 +1597,45 @@ class NetworkManagement:
             strip_command=True,
         )
 
+    def decrypt_credential(self, credential):
+        decrypted_credential = SimpleNamespace(
+            name=credential.name,
+            username=credential.username,
+            subtype=credential.subtype,
+            secret=env.get_password(credential.enable_password),
+        )
+        if credential.subtype == "password":
+            decrypted_credential.password = env.get_password(credential.password)
+        else:
+            private_key = env.get_password(credential.private_key)
+            decrypted_credential.pkey = RSAKey.from_private_key(StringIO(private_key))
+        return decrypted_credential
+
     def get_connection(self, library, device, name=None):
         cache = vs.connections_cache[library].get(self.parent_runtime, {})
         connection = name or getattr(self, "connection_name", "default")
         return cache.get(device, {}).get(connection)
 
     def get_credentials(self, device, add_secret=True):
-        result, credential_type = {}, self.cache["main_run_service"]["credential_type"]
-        credential = None
+        result, credential = {}, None
         if self.credentials == "object":
-            if self.high_performance:
-                with db.session_scope(remove=self.in_process):
-                    credential = db.fetch(
-                        "credential",
-                        user=self.creator,
-                        rbac="use",
-                        id=self.named_credential_id,
-                    )
-            else:
-                credential = self.named_credential
+            credential = self.get_named_credential(self.named_credential_id)
         elif self.credentials == "device" or add_secret:
-            with db.session_scope(remove=self.high_performance and self.in_process):
-                credential = db.get_credential(
-                    self.creator,
-                    device=device,
-                    credential_type=credential_type,
-                    optional=self.credentials != "device",
-                )
+            optional = self.credentials != "device"
+            credential = self.get_run_credential(device, optional=optional)
         if credential:
             device_log = f" for '{device.name}'" if device else ""
             if self.credentials == "custom":
                 device_log += " (for 'enable' / 'secret' password only, if needed)"
             self.log("info", f"Using '{credential.name}' credential{device_log}")
         if add_secret and device and credential:
-            result["secret"] = env.get_password(credential.enable_password)
+            result["secret"] = credential.secret
         if self.credentials in ("device", "object"):
             result["username"] = credential.username
             if credential.subtype == "password":
-                result["password"] = env.get_password(credential.password)
+                result["password"] = credential.password
             else:
-                private_key = env.get_password(credential.private_key)
-                result["pkey"] = RSAKey.from_private_key(StringIO(private_key))
+                result["pkey"] = credential.pkey
         else:
             result["username"] = self.sub(self.custom_username, locals())
             self.log("info", f"Using Custom Credentials (user: {result['username']})")
@@ -1148,31 +1648,83 @@ class NetworkManagement:
             result["password"] = password
         return result
 
+    def get_gateway_channel(self, device):
+        gateways = sorted(device.gateways, key=attrgetter("priority"), reverse=True)
+        parallel_attempts = env.gateway_transports.parallel_attempts or 1
+        for batch in batched(gateways, parallel_attempts):
+            attempts = []
+            for gateway in batch:
+                try:
+                    credentials = self.get_credentials(gateway, add_secret=False)
+                    attempts.append((gateway, credentials))
+                except Exception:
+                    error_log = f"Connection to {gateway} failed:\n{format_exc()}"
+                    self.log("error", error_log, device)
+            channel = attempts and self.race_gateways(attempts, device)
+            if channel:
+                return channel
+
+    def get_named_credential(self, credential_id):
+        store = vs.run_credentials[self.parent_runtime]["credentials"]
+        if credential_id not in store:
+            with db.session_scope(remove=self.high_performance and self.in_process):
+                credential = db.fetch(
+                    "credential", user=self.creator, rbac="use", id=credential_id
+                )
+                store[credential_id] = self.decrypt_credential(credential)
+        return store[credential_id]
+
+    def get_pool_key(self, library, device, driver, credentials, settings=None):
+        if self.credentials == "object":
+            credential_id = self.named_credential_id
+        elif self.credentials == "device":
+            credential_id = vs.run_credentials[self.parent_runtime]["devices"][
+                device.id
+            ]
+        else:
+            credential_id = None
+        secrets = [credentials.get(key) for key in ("password", "pkey", "secret")]
+        if isinstance(secrets[1], RSAKey):
+            secrets[1] = secrets[1].get_base64()
+        secrets_hash = sha256(str(secrets).encode("utf-8")).hexdigest()
+        settings = dumps(settings or {}, default=str, sort_keys=True)
+        settings_hash = sha256(settings.encode("utf-8")).hexdigest()
+        username = credentials["username"]
+        return (
+            library,
+            device.name,
+            driver,
+            username,
+            credential_id,
+            secrets_hash,
+            settings_hash,
+        )
+
+    def get_run_credential(self, device, optional=False):
+        if not device:
+            credential_type = self.cache["main_run_service"]["credential_type"]
+            with db.session_scope(remove=self.high_performance and self.in_process):
+                credential = db.get_credential(
+                    self.creator, credential_type=credential_type, optional=optional
+                )
+                return credential and self.decrypt_credential(credential)
+        store = vs.run_credentials[self.parent_runtime]
+        if device.id not in store["devices"]:
+            self.resolve_credentials([device, *self.run_targets])
+        credential_id = store["devices"][device.id]
+        if not credential_id and not optional:
+            raise Exception(f"No matching credentials found for DEVICE '{device.name}'")
+        return store["credentials"].get(credential_id)
+
     def get_or_close_connection(self, library, device):
         connection = self.get_connection(library, device)
         if not connection:
             return
         if self.start_new_connection:
             return self.disconnect(library, device, connection)
-        if library == "napalm":
-            if connection.is_alive():
-                return connection
-            else:
-                self.disconnect(library, device, connection)
-        elif library == "ncclient":
-            if connection.connected:
-                return connection
-            else:
-                self.disconnect(library, device, connection)
-        else:
-            try:
-                if library == "netmiko":
-                    connection.find_prompt()
-                else:
-                    connection.get_prompt()
-                return connection
-            except Exception:
-                self.disconnect(library, device, connection)
+        if env.connection_pool.is_alive(library, connection):
+            return connection
+        self.disconnect(library, device, connection)
 
     def napalm_connection(self, device):
         connection = self.get_or_close_connection("napalm", device.name)
@@ -1189,27 +1741,28 @@ class NetworkManagement:
             logger="security",
         )
         credentials = self.get_credentials(device)
-        optional_args = self.service.optional_args
-        if not optional_args:
-            optional_args = {}
+        driver = device.napalm_driver if self.driver == "device" else self.driver
+        settings = {
+            "optional_args": self.service.optional_args,
+            "timeout": self.timeout,
+        }
+        pool_key = self.get_pool_key("napalm", device, driver, credentials, settings)
+        napalm_connection = self.borrow_connection(device, pool_key)
+        if napalm_connection:
+            return napalm_connection
+        optional_args = dict(self.service.optional_args or {})
         if "secret" not in optional_args:
             optional_args["secret"] = credentials.pop("secret", None)
-        driver = get_network_driver(
-            device.napalm_driver if self.driver == "device" else self.driver
-        )
-        napalm_connection = driver(
-            hostname=device.ip_address,
-            timeout=self.timeout,
-            optional_args=optional_args,
-            **credentials,
-        )
-        napalm_connection.open()
-        napalm_connection.connection_name = self.connection_name
-        self.write_state("connections/napalm", 1, "increment", True)
-        vs.connections_cache["napalm"][self.parent_runtime].setdefault(device.name, {})[
-            self.connection_name
-        ] = napalm_connection
-        return napalm_connection
+        lease = self.acquire_device_lease(device)
+        with self.release_lease_on_failure(lease):
+            napalm_connection = get_network_driver(driver)(
+                hostname=device.ip_address,
+                timeout=self.timeout,
+                optional_args=optional_args,
+                **credentials,
+            )
+            napalm_connection.open()
+        return self.store_connection(device, napalm_connection, pool_key, lease)
 
     def ncclient_connection(self, device):
         connection = self.get_or_close_connection("ncclient", device.name)
@@ -1225,20 +1778,23 @@ class NetworkManagement:
             logger="security",
         )
         credentials = self.get_credentials(device)
-        ncclient_connection = manager.connect(
-            host=device.ip_address,
-            port=830,
-            hostkey_verify=False,
-            look_for_keys=False,
-            device_params={"name": device.netconf_driver or "default"},
-            username=credentials["username"],
-            password=credentials["password"],
-        )
-        ncclient_connection.connection_name = self.connection_name
-        vs.connections_cache["ncclient"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = ncclient_connection
-        return ncclient_connection
+        driver = device.netconf_driver or "default"
+        pool_key = self.get_pool_key("ncclient", device, driver, credentials)
+        ncclient_connection = self.borrow_connection(device, pool_key)
+        if ncclient_connection:
+            return ncclient_connection
+        lease = self.acquire_device_lease(device)
+        with self.release_lease_on_failure(lease):
+            ncclient_connection = manager.connect(
+                host=device.ip_address,
+                port=830,
+                hostkey_verify=False,
+                look_for_keys=False,
+                device_params={"name": driver},
+                username=credentials["username"],
+                password=credentials["password"],
+            )
+        return self.store_connection(device, ncclient_connection, pool_key, lease)
 
     def netmiko_connection(self, device):
         connection = self.get_or_close_connection("netmiko", device.name)
@@ -1255,57 +1811,47 @@ class NetworkManagement:
             change_log=False,
             logger="security",
         )
-        sock = None
-        if device.gateways:
-            gateways = sorted(device.gateways, key=attrgetter("priority"), reverse=True)
-            for gateway in gateways:
-                try:
-                    credentials = self.get_credentials(gateway, add_secret=False)
-                    connection_log = f"Trying to establish connection to {gateway}"
-                    self.log("info", connection_log, device, logger="security")
-                    client = SSHClient()
-                    client.set_missing_host_key_policy(AutoAddPolicy())
-                    client.connect(
-                        hostname=gateway.ip_address, port=gateway.port, **credentials
-                    )
-                    sock = client.get_transport().open_channel(
-                        "direct-tcpip", (device.ip_address, device.port), ("", 0)
-                    )
-                    break
-                except Exception:
-                    error_log = f"Connection to {gateway} failed:\n{format_exc()}"
-                    self.log("error", error_log, device)
-        netmiko_connection = ConnectHandler(
-            device_type=driver,
-            ip=device.ip_address,
-            port=device.port,
-            timeout=self.conn_timeout,
-            conn_timeout=self.conn_timeout,
-            auth_timeout=self.auth_timeout or None,
-            banner_timeout=self.banner_timeout,
-            read_timeout_override=self.read_timeout,
-            fast_cli=False,
-            global_delay_factor=self.global_delay_factor,
-            session_log=BytesIO(),
-            sock=sock,
-            **vs.automation["netmiko"]["connection_args"],
-            **self.get_credentials(device),
-        )
-        if self.enable_mode:
-            netmiko_connection.enable()
-        self.write_state("connections/netmiko", 1, "increment", True)
-        if self.config_mode:
-            kwargs = {}
-            if getattr(self, "config_mode_command", None):
-                kwargs["config_command"] = self.config_mode_command
-            netmiko_connection.config_mode(**kwargs)
-        netmiko_connection.password = "*" * 8
-        netmiko_connection.secret = "*" * 8
-        netmiko_connection.connection_name = self.connection_name
-        vs.connections_cache["netmiko"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = netmiko_connection
-        return netmiko_connection
+        credentials = self.get_credentials(device)
+        settings = {
+            "auth_timeout": self.auth_timeout,
+            "banner_timeout": self.banner_timeout,
+            "conn_timeout": self.conn_timeout,
+            "port": device.port,
+            "read_timeout": self.read_timeout,
+        }
+        pool_key = self.get_pool_key("netmiko", device, driver, credentials, settings)
+        netmiko_connection = self.borrow_connection(device, pool_key)
+        if netmiko_connection:
+            return self.update_netmiko_connection(netmiko_connection, device)
+        sock = self.get_gateway_channel(device) if device.gateways else None
+        lease = self.acquire_device_lease(device)
+        with self.release_lease_on_failure(lease):
+            netmiko_connection = ConnectHandler(
+                device_type=driver,
+                ip=device.ip_address,
+                port=device.port,
+                timeout=self.conn_timeout,
+                conn_timeout=self.conn_timeout,
+                auth_timeout=self.auth_timeout or None,
+                banner_timeout=self.banner_timeout,
+                read_timeout_override=self.read_timeout,
+                fast_cli=False,
+                global_delay_factor=self.global_delay_factor,
+                session_log=BytesIO(),
+                sock=sock,
+                **vs.automation["netmiko"]["connection_args"],
+                **credentials,
+            )
+            if self.enable_mode:
+                netmiko_connection.enable()
+            if self.config_mode:
+                kwargs = {}
+                if getattr(self, "config_mode_command", None):
+                    kwargs["config_command"] = self.config_mode_command
+                netmiko_connection.config_mode(**kwargs)
+            netmiko_connection.password = "*" * 8
+            netmiko_connection.secret = "*" * 8
+        return self.store_connection(device, netmiko_connection, pool_key, lease)
 
     def scrapli_connection(self, device):
         connection = self.get_or_close_connection("scrapli", device.name)
@@ -1323,11 +1869,14 @@ class NetworkManagement:
         )
         credentials = self.get_credentials(device)
         is_netconf = self.service.type == "scrapli_netconf_service"
+        if is_netconf:
+            platform = "netconf"
+        else:
+            platform = device.scrapli_driver if self.driver == "device" else self.driver
         connection_class, kwargs = NetconfDriver if is_netconf else Scrapli, {}
         if is_netconf:
             kwargs["strip_namespaces"] = self.strip_namespaces
         else:
-            platform = device.scrapli_driver if self.driver == "device" else self.driver
             kwargs.update(
                 {
                     "transport": self.transport,
@@ -1337,19 +1886,149 @@ class NetworkManagement:
                     "timeout_ops": self.timeout_ops,
                 }
             )
-        connection = connection_class(
-            host=device.ip_address,
-            auth_username=credentials["username"],
-            auth_password=credentials["password"],
-            **vs.automation["scrapli"]["connection_args"],
-            **kwargs,
+        pool_key = self.get_pool_key("scrapli", device, platform, credentials, kwargs)
+        connection = self.borrow_connection(device, pool_key)
+        if connection:
+            return connection
+        lease = self.acquire_device_lease(device)
+        with self.release_lease_on_failure(lease):
+            connection = connection_class(
+                host=device.ip_address,
+                auth_username=credentials["username"],
+                auth_password=credentials["password"],
+                **vs.automation["scrapli"]["connection_args"],
+                **kwargs,
+            )
+            connection.open()
+        return self.store_connection(device, connection, pool_key, lease)
+
+    def open_gateway_channel(self, gateway, credentials, device):
+        connection_log = f"Trying to establish connection to {gateway}"
+        self.log("info", connection_log, device, logger="security")
+
+        def connect():
+            client = SSHClient()
+            client.set_missing_host_key_policy(AutoAddPolicy())
+            client.connect(
+                hostname=gateway.ip_address, port=gateway.port, **credentials
+            )
+            return client
+
+        if env.gateway_transports.active:
+            pool_key = self.get_pool_key("gateway", gateway, None, credentials)
+            key = (gateway.ip_address, gateway.port, *pool_key)
+            transport = env.gateway_transports.get(key, connect)
+        else:
+            transport = connect().get_transport()
+        return transport.open_channel(
+            "direct-tcpip", (device.ip_address, device.port), ("", 0)
         )
-        connection.open()
+
+    def race_gateways(self, attempts, device):
+        if len(attempts) == 1:
+            try:
+                return self.open_gateway_channel(*attempts[0], device)
+            except Exception:
+                error_log = f"Connection to {attempts[0][0]} failed:\n{format_exc()}"
+                self.log("error", error_log, device)
+                return
+
+        def close_channel(future):
+            if future is winner or future.exception():
+                return
+            channel = future.result()
+            channel.close()
+            if not env.gateway_transports.active:
+                channel.get_transport().close()
+
+        executor = ThreadPoolExecutor(max_workers=len(attempts))
+        futures = {
+            executor.submit(self.open_gateway_channel, *attempt, device): attempt[0]
+            for attempt in attempts
+        }
+        winner = None
+        for future in as_completed(futures):
+            try:
+                future.result()
+                winner = future
+                break
+            except Exception:
+                error_log = f"Connection to {futures[future]} failed:\n{format_exc()}"
+                self.log("error", error_log, device)
+        executor.shutdown(wait=False)
+        for future in futures:
+            future.add_done_callback(close_channel)
+        return winner and winner.result()
+
+    def release_connection(self, library, device, connection):
+        if not env.connection_pool.active or not hasattr(connection, "pool_key"):
+            return self.disconnect(library, device, connection)
+        self.remove_connection(library, device, connection)
+        if connection.device_lease:
+            connection.device_lease.release()
+            connection.device_lease = None
+        env.connection_pool.release(connection)
+        connection_log = f"{library} connection '{connection.connection_name}'"
+        self.log("info", f"Returned {connection_log} to the connection pool", device)
+
+    @contextmanager
+    def release_lease_on_failure(self, lease):
+        try:
+            yield
+        except BaseException:
+            if lease:
+                lease.release()
+            raise
+
+    def remove_connection(self, library, device, connection):
+        vs.connections_cache[library][self.parent_runtime][device].pop(
+            connection.connection_name
+        )
+        if not vs.connections_cache[library][self.parent_runtime][device]:
+            vs.connections_cache[library][self.parent_runtime].pop(device)
+        self.write_state(f"connections/{library}", -1, "increment", True)
+
+    def resolve_credentials(self, devices):
+        store = vs.run_credentials[self.parent_runtime]
+        credential_type = self.cache["main_run_service"]["credential_type"]
+        device_ids = {device.id for device in devices} - set(store["devices"])
+        credential, pool, device = (
+            vs.models[model] for model in ("credential", "pool", "device")
+        )
+        device_credentials = {}
+        with db.session_scope(remove=self.high_performance and self.in_process):
+            for ids in batched(device_ids, vs.database["transactions"]["batch_size"]):
+                query = (
+                    db.query("credential", rbac="use", user=self.creator)
+                    .join(pool, credential.device_pools)
+                    .join(device, pool.devices)
+                    .filter(device.id.in_(ids))
+                    .add_columns(device.id)
+                )
+                if credential_type != "any":
+                    query = query.filter(credential.role == credential_type)
+                for device_credential, device_id in query.all():
+                    if device_credential.id not in store["credentials"]:
+                        store["credentials"][device_credential.id] = (
+                            self.decrypt_credential(device_credential)
+                        )
+                    priority = device_credential.priority
+                    if priority > device_credentials.get(device_id, (-inf,))[0]:
+                        device_credentials[device_id] = (priority, device_credential.id)
+        for device_id in device_ids:
+            store["devices"][device_id] = device_credentials.get(device_id, (0, None))[
+                1
+            ]
+
+    def store_connection(self, device, connection, pool_key, lease=None):
+        library = pool_key[0]
         connection.connection_name = self.connection_name
-        self.write_state("connections/scrapli", 1, "increment", True)
-        vs.connections_cache["scrapli"][self.parent_runtime].setdefault(
-            device.name, {}
-        )[self.connection_name] = connection
+        connection.pool_key = pool_key
+        connection.device_lease = lease
+        self.write_state(f"connections/{library}", 1, "increment", True)
+        vs.connections_cache[library][self.parent_runtime].setdefault(device.name, {})[
+            self.connection_name
+        ] = connection
         return connection
 
     def transfer_file(self, ssh_client, files):
@@ -1419,7 +2098,10 @@ class GlobalVariables:
             raise ImportError(f"Module '{module}' is restricted.")
         return importlib_import(module, *args, **kwargs)
 
+    safe_builtins = ReadOnlyDict({**builtins, "__import__": _import.__func__})
+
     def get_all_results(self):
+        env.result_writer.flush()
         return db.fetch_all("result", parent_runtime=self.parent_runtime, rbac=None)
 
     def get_credential(self, **kwargs):
@@ -1472,9 +2154,10 @@ class GlobalVariables:
                 if device:
                     results = list(map(or_loads, env.redis("lrange", path, 0, -1)))
                 else:
+                    index = f"{self.parent_runtime}/results/{service_key}"
                     results = [
                         or_loads(result)
-                        for key in env.redis("keys", path)
+                        for key in env.redis("smembers", index) or []
                         for result in env.redis("lrange", key, 0, -1)
                     ]
             else:
@@ -1499,6 +2182,7 @@ class GlobalVariables:
             if self.high_performance and run == self.main_run:
                 if results := get_transient_results():
                     return results
+            env.result_writer.flush()
             with db.session_scope(remove=self.high_performance and self.in_process):
                 query = db.session.query(vs.models["result"]).filter(
                     vs.models["result"].parent_runtime == (runtime or run.runtime)
@@ -1532,43 +2216,59 @@ class GlobalVariables:
     def get_var(self, *args, **kwargs):
         return self.payload_helper(*args, operation="get", **kwargs)
 
+    def build_global_variables(self):
+        namespace = {
+            "delete": partial(self.internal_function, "delete"),
+            "dry_run": getattr(self, "dry_run", False),
+            "get_all_results": self.get_all_results,
+            "get_connection": self.get_connection,
+            "get_var": self.get_var,
+            "factory": partial(self.internal_function, "factory"),
+            "fetch": partial(self.internal_function, "fetch"),
+            "fetch_all": partial(self.internal_function, "fetch_all"),
+            "filtering": partial(self.internal_function, "filtering"),
+            "get_result": self.get_result,
+            "get_secret": self.get_secret,
+            "get_data": self.get_data,
+            "log": partial(self.log, user_defined=True),
+            "remove_note": self.remove_note,
+            "set_note": self.set_note,
+            "set_var": self.payload_helper,
+            "workflow": self.workflow,
+        }
+        namespace.update(self.cache["global_variables"])
+        namespace.update(vs.custom.runner_global_variables(self))
+        if self.cache["creator"]["is_admin"]:
+            namespace["get_credential"] = self.get_credential
+        return MappingProxyType(namespace)
+
     def global_variables(_self, **locals):  # noqa: N805
         payload, device = _self.payload, locals.get("device")
+        if _self.global_variables_base is None:
+            base = _self.build_global_variables()
+            _self.global_builtins = ReadOnlyDict({**_self.safe_builtins, **base})
+            _self.global_variables_base = base
+        base = _self.global_variables_base
         variables = {**locals, **payload.get("form", {})}
         variables.update(payload.get("variables", {}))
         if device and "devices" in payload.get("variables", {}):
             variables.update(payload["variables"]["devices"].get(device.name, {}))
+        variables.update(getattr(_self.iteration_overrides, "variables", {}))
         variables.update(
             {
-                "__builtins__": {**builtins, "__import__": _self._import},
-                "delete": partial(_self.internal_function, "delete"),
                 "devices": _self.run_targets,
-                "dry_run": getattr(_self, "dry_run", False),
-                "get_all_results": _self.get_all_results,
-                "get_connection": _self.get_connection,
-                "get_var": _self.get_var,
-                "factory": partial(_self.internal_function, "factory"),
-                "fetch": partial(_self.internal_function, "fetch"),
-                "fetch_all": partial(_self.internal_function, "fetch_all"),
-                "filtering": partial(_self.internal_function, "filtering"),
-                "get_result": _self.get_result,
-                "get_secret": _self.get_secret,
-                "get_data": _self.get_data,
-                "log": partial(_self.log, user_defined=True),
                 "parent_device": _self.parent_device or device,
-                "payload": _self.payload,
-                "remove_note": _self.remove_note,
-                "set_note": _self.set_note,
-                "set_var": _self.payload_helper,
-                "workflow": _self.workflow,
-                **_self.cache["global_variables"],
-                **vs.custom.runner_global_variables(_self),
+                "payload": payload,
             }
         )
-        if _self.cache["creator"]["is_admin"]:
-            variables["get_credential"] = _self.get_credential
+        for name in variables.keys() & base.keys():
+            del variables[name]
+        variables["__builtins__"] = _self.global_builtins
         return variables
 
+    def template_variables(_self, **locals):  # noqa: N805
+        return {**_self.global_variables(**locals), **_self.global_variables_base}
+
     def internal_function(self, func, _model, **kwargs):
         if _model not in vs.automation["workflow"]["allowed_models"][func]:
             raise db.rbac_error(f"Use of '{func}' not allowed on {_model}s.")
@@ -1601,6 +2301,9 @@ class GlobalVariables:
         allow_none=False,
         default=None,
     ):
+        overrides = getattr(self.iteration_overrides, "variables", {})
+        if operation == "get" and not section and name in overrides:
+            return overrides[name]
         payload = self.payload.setdefault("variables", {})
         if device:
             payload = payload.setdefault("devices", {})
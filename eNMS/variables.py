@@ -165,7 +165,11 @@ class VariableStore:
         self.run_states = defaultdict(dict)
         self.run_logs = defaultdict(lambda: defaultdict(list))
         self.run_stop = defaultdict(bool)
+        self.run_templates = defaultdict(dict)
         self.run_instances = {}
+        self.run_branch_slots = {}
+        self.run_credentials = defaultdict(lambda: {"credentials": {}, "devices": {}})
+        self.run_contexts = {}
         libraries = ("netmiko", "napalm", "scrapli", "ncclient")
         self.connections_cache = {library: defaultdict(dict) for library in libraries}
         self.service_run_count = defaultdict(int)
@@ -174,6 +178,7 @@ class VariableStore:
             lambda: defaultdict(lambda: defaultdict(list))
         )
         self.service_changelog = defaultdict(list)
+        self.subprocess_state = None
 
     def _set_server_variables(self):
         self.server = getenv("SERVER_NAME", "Localhost")
@@ -0,0 +1,31 @@
+# Convert the results stored as pickles to the compressed JSON format.
+# Results that are still pickled are decoded transparently, so this script
+# is only needed to reclaim the storage space used by older results.
+# It must be run from the eNMS folder: python files/scripts/compress_results.py
+
+from itertools import batched
+from sqlalchemy import bindparam, Column, Integer, LargeBinary, MetaData, select, Table
+
+from eNMS.database import db
+
+result_table = Table(
+    "result", MetaData(), Column("id", Integer), Column("result", LargeBinary)
+)
+update = (
+    result_table.update()
+    .where(result_table.c.id == bindparam("result_id"))
+    .values(result=bindparam("compressed_result"))
+)
+
+with db.engine.connect() as connection:
+    ids = connection.execute(select(result_table.c.id)).scalars().all()
+    for batch in batched(ids, db.transactions["batch_size"]):
+        query = select(result_table).where(result_table.c.id.in_(batch))
+        values = [
+            {"result_id": id, "compressed_result": db.compress(db.decompress(result))}
+            for id, result in connection.execute(query)
+            if result and result.startswith(b"\x80")
+        ]
+        if values:
+            connection.execute(update, values)
+        connection.commit()
@@ -0,0 +1,73 @@
+from collections import defaultdict
+from importlib.util import module_from_spec, spec_from_file_location
+from pathlib import Path
+from pytest import fixture
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.commands = redis, []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+
+        return command
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        if self.redis.unreachable:
+            raise ConnectionError("Redis is unreachable")
+        return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes, self.lists, self.sets = defaultdict(dict), defaultdict(list), {}
+        self.unreachable = False
+
+    def hdel(self, key, field):
+        self.hashes[key].pop(field, None)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hincrby(self, key, field, value):
+        self.hashes[key][field] = str(int(self.hashes[key].get(field, 0)) + value)
+
+    def hset(self, key, field, value):
+        self.hashes[key][field] = str(value)
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lrange(self, key, start, end):
+        values = self.lists.get(key, [])
+        return values[start : None if end == -1 else end + 1]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def rpush(self, key, *values):
+        self.lists[key].extend(map(str, values))
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+
+@fixture(scope="session")
+def helpers():
+    path = Path(__file__).parents[1] / "eNMS" / "helpers.py"
+    spec = spec_from_file_location("helpers", path)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@fixture
+def redis():
+    return FakeRedis()
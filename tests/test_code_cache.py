@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+
+def test_compile_service_without_last_modified(helpers):
+    cache = helpers.CodeCache()
+    service = SimpleNamespace(id=2, last_modified=None)
+    assert eval(cache.compile("1+2", "eval", service)) == 3
+    assert eval(cache.compile("1+2", "eval", service)) == 3
+    assert cache.statistics["hits"] == 1
+
+
+def test_modified_service_invalidates_its_code(helpers):
+    cache = helpers.CodeCache()
+    service = SimpleNamespace(id=1, last_modified=None)
+    cache.compile("1+2", "eval", service)
+    service.last_modified = "2024-01-01 00:00:00"
+    cache.compile("3+4", "eval", service)
+    assert cache.statistics["size"] == 1
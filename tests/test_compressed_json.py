@@ -0,0 +1,13 @@
+from datetime import datetime
+
+
+def test_compress_preserves_non_json_values(helpers):
+    value = {1: "int key", "tuple": (1, 2), "date": datetime(2024, 1, 1)}
+    assert helpers.decompress(helpers.compress(value)) == value
+
+
+def test_compress_json_payload(helpers):
+    value = {"success": True, "result": [1, 2.5, "text", None]}
+    data = helpers.compress(value)
+    assert helpers.or_loads(helpers.zlib_decompress(data)) == value
+    assert helpers.decompress(data) == value
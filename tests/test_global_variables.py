@@ -0,0 +1,14 @@
+from builtins import __dict__ as builtins
+from pytest import raises
+
+
+def test_read_only_builtins(helpers):
+    safe_builtins = helpers.ReadOnlyDict(builtins)
+    variables = {"__builtins__": safe_builtins, "values": [1, 2]}
+    exec("import math\nclass Value: pass\nresult = len(values)", variables)
+    assert variables["result"] == 2
+    with raises(TypeError):
+        exec("__builtins__['len'] = None", variables)
+    with raises(TypeError):
+        safe_builtins.update(len=None)
+    assert safe_builtins["len"] is len
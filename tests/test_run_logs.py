@@ -0,0 +1,25 @@
+def test_logs_are_read_across_redis_and_buffer(helpers, redis):
+    buffer = helpers.RunLogBuffer(redis)
+    for line in range(3):
+        buffer.add("runtime", "runtime/1/logs", f"line {line}")
+    buffer.flush()
+    buffer.add("runtime", "runtime/1/logs", "line 3")
+    assert buffer.read("runtime", "runtime/1/logs") == [
+        "line 0",
+        "line 1",
+        "line 2",
+        "line 3",
+    ]
+    assert buffer.read("runtime", "runtime/1/logs", 2) == ["line 2", "line 3"]
+    assert buffer.read("runtime", "runtime/1/logs", 4) == []
+
+
+def test_logs_are_kept_when_redis_is_unreachable(helpers, redis):
+    buffer = helpers.RunLogBuffer(redis)
+    buffer.add("runtime", "runtime/1/logs", "line 0")
+    redis.unreachable = True
+    buffer.flush()
+    buffer.add("runtime", "runtime/1/logs", "line 1")
+    redis.unreachable = False
+    buffer.flush()
+    assert redis.lists["runtime/1/logs"] == ["line 0", "line 1"]
@@ -0,0 +1,29 @@
+def test_appended_state_is_returned_in_redis_mode(helpers, redis):
+    store = helpers.RunStateStore(redis)
+    store.write("runtime", "service/status", "Running")
+    store.write("runtime", "service/progress/device/success", 2, "increment")
+    store.write("runtime", "service/concurrency/history", "2024-01-01: 2", "append")
+    store.write("runtime", "service/concurrency/history", "2024-01-01: 3", "append")
+    store.write("runtime", "service/success", "True")
+    store.flush()
+    assert store.read("runtime") == {
+        "service": {
+            "status": "Running",
+            "progress": {"device": {"success": "2"}},
+            "concurrency": {"history": ["2024-01-01: 2", "2024-01-01: 3"]},
+            "success": True,
+        }
+    }
+
+
+def test_local_state(helpers):
+    store = helpers.RunStateStore()
+    store.write("runtime", "service/progress/device/success", 1, "increment")
+    store.write("runtime", "service/progress/device/success", 1, "increment")
+    store.write("runtime", "service/concurrency/history", "2024-01-01: 2", "append")
+    assert store.read("runtime") == {
+        "service": {
+            "progress": {"device": {"success": 2}},
+            "concurrency": {"history": ["2024-01-01: 2"]},
+        }
+    }
@@ -0,0 +1,23 @@
+from datetime import datetime
+from orjson import loads
+
+
+def test_serialize_keeps_datetime_and_integer_keys(helpers):
+    timestamp = datetime(2024, 1, 1, 12, 30)
+    result, data = helpers.encode_json({"time": timestamp, "interfaces": {1: "up"}})
+    assert result == {"time": str(timestamp), "interfaces": {1: "up"}}
+    assert data == b'{"time": "2024-01-01 12:30:00", "interfaces": {"1": "up"}}'
+
+
+def test_serialize_converts_tuples_and_non_finite_floats(helpers):
+    value = {"range": (1, 2), "limits": [float("inf"), float("-inf"), float("nan")]}
+    result, data = helpers.encode_json(value)
+    assert result == {"range": "(1, 2)", "limits": ["inf", "-inf", "nan"]}
+    assert loads(data) == result
+
+
+def test_serialize_round_trip(helpers):
+    value = {"success": True, "result": ["a", 1, 2.5, None], "nested": {"b": {}}}
+    result, data = helpers.encode_json(value)
+    assert result == value
+    assert helpers.encode_json(result)[1] == data